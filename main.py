@@ -10,12 +10,301 @@ João Bernardino - 83696
 
 import probability
 
-# Flag for algorithm: False = elimination_ask, True = enumeration_ask
-algorithm = False
+# Inference algorithm used by Problem.solve:
+#   'elimination'   = variable elimination for each room, with an elimination plan compiled once per museum
+#   'enumeration'   = enumeration_ask for each room, caching the sums over the rest of the network (exact, for reference)
+#   'junction_tree' = one junction tree calibration for all rooms
+#   'circuit'       = one forward and backward sweep of an arithmetic circuit compiled once per museum, for all rooms
+#   'sampling'      = likelihood weighting for all rooms, drawing the samples at once (approximate, for large museums)
+#   'gibbs'         = Gibbs sampling with many chains, resampling the whole history of a room at once (approximate)
+#   'loopy'         = loopy belief propagation on the unrolled network, for all rooms (approximate, for very large museums)
+#   'filtering'     = exact filtering over the time steps, without unrolling the network
+#   'factored'      = approximate (Boyen-Koller) filtering with independent clusters of rooms, for large museums
+#   'particle'      = particle filtering over the time steps (approximate, for very large museums)
+#   'auto'          = 'junction_tree' when its estimated cost fits the budgets below, the approximate algorithm otherwise
+algorithm = 'junction_tree'
+
+# Accepted names for the algorithm argument (the old boolean flag is still accepted: 0=elimination, 1=enumeration)
+algorithms = ('elimination', 'enumeration', 'junction_tree', 'circuit', 'sampling', 'gibbs', 'loopy', 'filtering', 'factored', 'particle',
+              'auto')
+
+# Budgets of the 'auto' algorithm: exact inference is used when its largest table takes at most memory_budget bytes and its
+# estimated flops at most time_budget seconds at flop_rate flops per second (about the speed of the junction tree calibrations);
+# otherwise the approximate algorithm is used ('particle' by default, whose cost is linear in the rooms and the time instants)
+memory_budget = 2**30
+time_budget = 60.0
+flop_rate = 5e7
+approximate = 'particle'
+
+# Number of sums over the rest of the network cached by the 'enumeration' algorithm (0 = plain enumeration, without memoization)
+enumeration_cache = 2**16
+
+# Number of particles of the 'particle' algorithm, and how they are resampled ('systematic' or 'residual')
+particles = 10000
+resampling = 'systematic'
+
+# Clusters of rooms kept jointly by the 'factored' algorithm, as a list of lists of room names (None = one cluster per room)
+clusters = None
+
+# Number of samples drawn by the 'sampling' algorithm
+samples = 100000
+
+# Number of chains, and of sweeps counted after the burn-in sweeps, of the 'gibbs' algorithm
+chains = 100
+sweeps = 200
+burn_in = 50
+
+# Damping of the messages, maximum number of iterations, tolerance on the change of the messages and message schedule
+# ('residual' or 'synchronous') of the 'loopy' algorithm
+damping = 0.5
+max_iterations = 200
+tolerance = 1e-6
+schedule = 'residual'
+
+# Flag to solve each connected component of the museum (rooms connected to each other, but not to the others) on its own, and
+# number of seconds of estimated exact inference above which the components are solved in parallel processes
+decompose = True
+parallel_seconds = 1.0
+
+# Flag to use the symmetries of the museum: twin rooms (same connections, sensors and measurements) without measurements are lumped
+# into aggregate rooms, and the probability of fire of the others is calculated once per class
+symmetry = True
+
+# Largest number of rooms of a museum without measurements whose probabilities are calculated in closed form, by propagating the
+# prior over all the sets of rooms on fire (memory grows as 3**rooms); isolated rooms are always calculated in closed form
+closed_form_rooms = 12
+
+# Initial i-bound (largest number of variables of a mini-bucket) of the bounds used by solve_topk() to rank the rooms without solving
+# them, and its increase when the bounds of a connected component are not tight enough; a component is solved instead once
+# bounding it would cost as much as solving it
+topk_i_bound = 8
+topk_i_step = 4
+
+# Flag to remove, before inference, the nodes irrelevant to the rooms queried (barren and d-separated nodes)
+prune = True
+
+# Flag to print the drift of the 'factored' algorithm from exact filtering (only feasible for small museums)
+drift = False
+
+# Elimination order used by elimination_ask: 'reverse', 'min_degree', 'min_fill' or 'weighted_min_fill'
+ordering = 'min_fill'
 
 # Flag for debug prints
 debug = False
 
+# Number of compiled models (networks, junction trees, elimination plans) kept in memory by the model cache (0 = no cache)
+cache_size = 32
+
+# Directory of the on-disk tier of the model cache, shared by processes and runs (None = memory only)
+cache_dir = None
+
+# Model cache used by Problem, created by get_model_cache()
+model_cache = None
+
+# Names of the module options above, passed to the worker processes by get_options()
+option_names = ('algorithm', 'memory_budget', 'time_budget', 'flop_rate', 'approximate', 'enumeration_cache', 'particles',
+                'resampling', 'clusters', 'samples', 'chains', 'sweeps', 'burn_in', 'damping', 'max_iterations', 'tolerance',
+                'schedule', 'decompose', 'parallel_seconds', 'symmetry', 'closed_form_rooms', 'topk_i_bound', 'topk_i_step',
+                'prune', 'drift', 'ordering', 'debug', 'cache_size', 'cache_dir')
+
+class ModelCache:
+    """A least recently used cache of compiled models, with an optional on-disk tier.
+    Input files of the same museum (same rooms, connections, sensors and propagation probability) that differ only in the values
+    of the measurements have the same networks, junction trees and elimination plans, so only the evidence has to be absorbed.
+
+    ...
+
+    Attributes
+    ----------
+    size : int
+        Maximum number of models kept in memory.
+    directory : string
+        Directory where the models are pickled, or None to keep them in memory only.
+    version : string
+        Hash of the sources of this module and of probability.py, in the names of the pickle files, so that models pickled by
+        other versions of the code are never loaded.
+    entries : collections.OrderedDict
+        The models in memory, from the least to the most recently used.
+    hits : int
+        Number of models found in memory or on disk.
+    misses : int
+        Number of models built.
+
+    Methods
+    -------
+    key(*parts)
+        Returns the content hash of the parts, used as key.
+    get(key, build)
+        Returns the model with the given key, calling build() to create it if it is not cached.
+    filename(key)
+        Returns the name of the pickle file of the model with the given key.
+    load(key)
+        Returns the model with the given key from the directory, or None.
+    dump(key, model)
+        Saves the model with the given key in the directory.
+    """
+
+    def __init__(self, size=32, directory=None):
+        """Creates an empty cache.
+
+        Parameters
+        ----------
+        size : int
+            Maximum number of models kept in memory.
+        directory : string
+            Directory where the models are pickled, or None to keep them in memory only.
+        """
+
+        from collections import OrderedDict
+        import hashlib
+
+        self.size = size
+        self.directory = directory
+
+        sources = hashlib.sha256()
+        for module in (__file__, probability.__file__):
+            with open(module, 'rb') as f:
+                sources.update(f.read())
+        self.version = sources.hexdigest()[:16]
+
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(*parts):
+        """Returns the content hash of the parts (strings, numbers, and lists, tuples and dictionaries of them).
+
+        Parameters
+        ----------
+        parts
+            The data the model depends on.
+
+        Returns
+        -------
+        key : string
+            SHA-256 hexadecimal digest of the representation of the parts.
+        """
+
+        import hashlib
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    def get(self, key, build):
+        """Returns the model with the given key: from memory, from the directory or, if it is not cached, built by build().
+
+        Parameters
+        ----------
+        key : string
+            Key of the model, as returned by key().
+        build : function
+            Function without arguments that creates the model.
+
+        Returns
+        -------
+        model
+            The cached or created model.
+        """
+
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        model = self.load(key)
+        if model is None:
+            self.misses += 1
+            model = build()
+            self.dump(key, model)
+        else:
+            self.hits += 1
+
+        # Evict the least recently used models
+        if self.size > 0:
+            self.entries[key] = model
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+        return model
+
+    def filename(self, key):
+        """Returns the name of the pickle file of the model with the given key, in the directory.
+
+        Parameters
+        ----------
+        key : string
+            Key of the model, as returned by key().
+
+        Returns
+        -------
+        filename : string
+            Path of the file, named after the key and the version of the code.
+        """
+
+        import os.path
+        return os.path.join(self.directory, f'{key}-{self.version}.pickle')
+
+    def load(self, key):
+        """Returns the model with the given key from the directory, or None if it isn't there (or can't be read).
+
+        Parameters
+        ----------
+        key : string
+            Key of the model, as returned by key().
+        """
+
+        import pickle
+
+        if self.directory is None:
+            return None
+        try:
+            with open(self.filename(key), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def dump(self, key, model):
+        """Saves the model with the given key in the directory, if there is one. The file is written under a temporary name and
+        then renamed, so processes sharing the directory never read a partial file.
+
+        Parameters
+        ----------
+        key : string
+            Key of the model, as returned by key().
+        model
+            The model to save.
+        """
+
+        import os
+        import pickle
+
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        filename = self.filename(key)
+        temporary = f'{filename}.{os.getpid()}'
+
+        try:
+            with open(temporary, 'wb') as f:
+                pickle.dump(model, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, filename)
+        except (OSError, pickle.PicklingError):
+            # The model is still cached in memory
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+def get_model_cache():
+    """Returns the model cache used by Problem, created again when the module variables cache_size or cache_dir change.
+
+    Returns
+    -------
+    model_cache : ModelCache
+    """
+
+    global model_cache
+    if model_cache is None or (model_cache.size, model_cache.directory) != (cache_size, cache_dir):
+        model_cache = ModelCache(cache_size, cache_dir)
+    return model_cache
+
 class Problem:
     """A class used to represent the museum fire problem. It used a Baye network and the variable elimination algorithm of the AIMA repository (https://github.com/aimacode/aima-python)
 
@@ -23,43 +312,99 @@ class Problem:
 
     Attributes
     ----------
+    rooms : list
+        List containing the room names.
+    dbn : probability.DynamicBayesNet
+        The dynamic Bayesian network of the museum: one slice of room and sensor nodes, repeated at every time instant. It is
+        created on first use.
+    readings : list of dictionaries
+        The measurements of each time instant, as dictionaries where the key is the sensor name and the value the measurement.
     bayes_net : probability.BayesNet
         A Bayesian network as implemented in the AIMA repository.
-        This network will represent the museum fire problem.
+        This network will represent the museum fire problem. It is the dbn unrolled for all the time instants, created on first use.
     evidence: dictionary
         This dictionary will contain, the measurements/evidences in the format used by the AIMA repository.
         The keys are the sensor name and time instant and the values are the corresponding measurements.
     last_nodes: list
         A list containing the name of the last nodes.
         This is used when calling the elimination ask for the last nodes (corresponding to the last time instant).
+    museum : string
+        Content hash of the rooms, connections, sensors and propagation probability, used as key of the model cache.
+    pattern : tuple of tuples
+        The names of the sensors measured at each time instant, which also define the compiled models.
+    data : tuple
+        The problem input variables (R, C, S, P, M), as returned by load_file().
+    fire_prior : float or dictionary
+        Probability of fire of each room at the first time instant (or a dictionary with the one of each room).
+    certified : boolean
+        Whether the ranking of the last solve_topk() is certain (its bounds of the probabilities do not overlap).
 
     Methods
     -------
     __init__(fh)
         Initializes the problem using the file object fh. It creates the Bayes network.
+    from_data(R, C, S, P, M)
+        Creates the problem from already loaded input variables.
+    setup(R, C, S, P, M)
+        Creates the Bayes network and the attributes from the input variables.
+    compile(kind)
+        Returns a compiled model (junction tree, arithmetic circuit, sampler or elimination plans) from the model cache, creating it if needed.
+    estimate()
+        Estimates the cost of exact inference, without building any table.
+    choose_algorithm(cost)
+        Returns the algorithm used by the 'auto' algorithm: exact inference if its cost fits the budgets, approximate otherwise.
     solve()
         Returns the solution room name and likelihood.
+    solve_topk(k)
+        Returns the k rooms most likely to be on fire, with bounds of their probability, refining the bounds only where needed.
+    bounds(i_bound)
+        Returns bounds of the probability of fire of each room, from mini-bucket elimination.
+    marginals()
+        Returns the probability of fire of each room at the last time instant.
+    closed_form()
+        Returns the probability of fire of each room without any Bayesian network, for isolated rooms and museums without measurements.
+    spread_prior(parents, P)
+        Returns the probability of fire of each room, without measurements.
+    twins()
+        Returns the classes of twin rooms, which have the same probability of fire.
+    lump()
+        Returns the problem where the twin rooms without measurements are lumped into aggregate rooms.
+    split()
+        Returns the problems of the connected components of the museum.
+    solve_components(components)
+        Returns the probability of fire of each room, solving each connected component on its own (in parallel when large).
+    most_likely(results)
+        Returns the room with maximum probability of fire and its probability.
+    create_filter(kind)
+        Creates the filter used by the filtering algorithms.
+    run_filter(belief)
+        Runs a filtering algorithm over the measurements.
+    stream(measurements)
+        Solves the problem online, yielding the most likely room after the measurements of each time instant.
+    drift()
+        Measures how far approximate filtering is from exact filtering at each time instant.
     load_file(f)
         From an open file f, reads each line and processes it, creating the problem input variables.
+    parse_line(line)
+        Parses a line of the input file.
     get_parents(R, C)
         Returns a dictionary where the keys are the rooms names and the values are lists of connections (including a connection with itself).
         This facilitates the generation of the Bayes network.
-    get_conditional_probabilities(R, P, parents)
-        Returns a dictionary where the keys are the rooms names and the values are dictionaries of a truth table and the conditional probabilities
-        (of fire propagation) for the rooms nodes. It is used to create the Bayes network.
     get_sensor_probabilities(S)
         Creates a dictionary containing the sensors nodes conditional probabilities of TPR and FPR. 
         This facilitates the generation of the Bayes network.
     get_evidence(S, M)
         Returns a dictionary containing the measurements/evidences in the format used by elimination_ask().
-    create_bayes_net(R, S, M, parents, cond_prob, sensor_prob, P_F)
+    create_dynamic_bayes_net(R, S, P, parents, sensor_prob, P_F)
+        Creates the dynamic Bayesian network for the museum fire problem: the prior, transition and sensor nodes of a time instant.
+    create_bayes_net(dbn, readings)
         Creates the Bayesian network for the museum fire problem, as implemented in the AIMA repository.
     """
 
     def __init__(self, fh):
         """Reads the opened file object fh and creates a Bayesian network accordingly to the museum fire problem.
         The Bayesian network with the class probability.BayesNet from the AIMA repository.
-        Initializes the attributes: last_nodes, evidence and bayes_net.
+        Initializes the attributes: rooms, dbn, readings, last_nodes and evidence.
 
         ...
 
@@ -71,28 +416,73 @@ class Problem:
 
         # Reads the file and loads its data into variables
         R, C, S, P, M = self.load_file(fh)
+        if not R:
+            raise ValueError("Not a museum fire problem: no rooms (R line)")
 
-        # Get a dictionary containing the parents of each node
-        parents = self.get_parents(R, C)
+        self.setup(R, C, S, P, M)
+
+    @classmethod
+    def from_data(cls, R, C, S, P, M, P_F=0.5):
+        """Creates a problem from already loaded data, as returned by load_file().
+
+        Parameters
+        ----------
+        R, C, S, P, M
+            The problem input variables, as returned by load_file(). P may also be a dictionary with the propagation probability
+            of each room.
+        P_F : float or dictionary
+            Probability of fire of the rooms at the first time instant (or a dictionary with the one of each room).
 
-        # Get a dictionary containing the conditional probabilities tables from the room nodes
-        cond_prob = self.get_conditional_probabilities(R, P, parents)
+        Returns
+        -------
+        problem : Problem
+            The museum fire problem.
+        """
+
+        problem = cls.__new__(cls)
+        problem.setup(R, C, S, P, M, P_F)
+        return problem
 
-        # Get a dictionary containing the conditional probabilities tables from the sensor nodes
-        sensor_prob = self.get_sensor_probabilities(S)
+    def setup(self, R, C, S, P, M, P_F=0.5):
+        """Creates the dynamic Bayesian network of the museum fire problem and initializes the attributes: rooms, dbn, readings,
+        last_nodes and evidence.
+
+        Parameters
+        ----------
+        R, C, S, P, M
+            The problem input variables, as returned by load_file() (P may be a dictionary, see from_data()).
+        P_F : float or dictionary
+            Probability of fire of the rooms at the first time instant (or a dictionary with the one of each room).
+        """
 
         # Get a dictiionary containing the evidence/measurements in the format used by the elimination_ask()
         self.evidence = self.get_evidence(S, M)
 
+        # Input variables, from which the problems of the connected components are created
+        self.data = (R, C, S, P, M)
+
+        # Measurements of each time instant, as used by the filtering algorithms
+        self.readings = [{m['sensor']: m['measurement'] for m in measurements} for measurements in M]
+        self.rooms = R
+
         # Name of the room nodes at the last instant
         n = len(M)-1
         self.last_nodes = [room+f'@{n}' for room in R]
 
         # Probability of fire. Since there's no information which rooms are on fire, it's like flipping a coin - 50/50 probability
-        P_F = 0.5
+        # (the rooms lumped by lump() have others)
+        self.fire_prior = P_F
+
+        # Keys of the compiled models in the model cache: the museum, and the sensors measured at each time instant
+        self.museum = ModelCache.key(R, C, S, P, P_F)
+        self.pattern = tuple(tuple(sorted(readings)) for readings in self.readings)
 
-        # Create Bayesian Network
-        self.bayes_net = self.create_bayes_net(R, S, M, parents, cond_prob, sensor_prob, P_F)
+        # The dynamic and the unrolled Bayesian networks are only created when an algorithm needs them
+        self._dbn = None
+        self._bayes_net = None
+
+        # Set by solve_topk()
+        self.certified = None
 
         if debug:
             # Print the created variables
@@ -101,12 +491,141 @@ class Problem:
             print('Sensors', '\n', S, '\n')
             print('Probability', '\n', P, '\n')
             print('Measurement', '\n', M, '\n')
-            print('Connections2', '\n', parents, '\n')
+            print('Connections2', '\n', self.get_parents(R, C), '\n')
             print('Bayesian Network', '\n', self.bayes_net, '\n');
 
+    @property
+    def dbn(self):
+        """The dynamic Bayesian network of the museum fire problem, created on first use. It only depends on the museum, so it is
+        shared through the model cache."""
+        if self._dbn is None:
+            R, C, S, P, _ = self.data
+
+            def build():
+                # Get a dictionary containing the parents of each node
+                parents = self.get_parents(R, C)
+
+                # Get a dictionary containing the conditional probabilities tables from the sensor nodes
+                sensor_prob = self.get_sensor_probabilities(S)
+
+                return self.create_dynamic_bayes_net(R, S, P, parents, sensor_prob, self.fire_prior)
+
+            self._dbn = get_model_cache().get(ModelCache.key('dbn', self.museum), build)
+        return self._dbn
+
+    @property
+    def bayes_net(self):
+        """The Bayesian network of the museum fire problem (the dbn unrolled for all the time instants), created on first use.
+        It only depends on the museum and on which sensors were measured, so it is shared through the model cache."""
+        if self._bayes_net is None:
+            key = ModelCache.key('network', self.museum, self.pattern)
+            self._bayes_net = get_model_cache().get(key, lambda: self.create_bayes_net(self.dbn, self.readings))
+        return self._bayes_net
+
+    def compile(self, kind):
+        """Returns the compiled model of the given kind, from the model cache, or created and then cached.
+        These models only depend on the museum, on which sensors were measured and on the options, not on the measured values.
+
+        Parameters
+        ----------
+        kind : string
+            'junction_tree' for the probability.JunctionTree of the (pruned) network, compiled for the evidence variables,
+            'circuit' for the probability.ArithmeticCircuit of the (pruned) network,
+            'sampler' for the probability.ForwardSampler of the (pruned) network, without decomposing its noisy-OR nodes,
+            'loopy' for the probability.LoopyBeliefPropagation of the (pruned) network, or
+            'elimination' for a dictionary where the keys are the last nodes and the values are their probability.EliminationPlan,
+            compiled on their (pruned) networks for the evidence variables (only for the first room of each class of twins).
+
+        Returns
+        -------
+        model : probability.JunctionTree or dictionary
+        """
+
+        evidence_variables = set(self.evidence)
+
+        def build():
+            if kind == 'junction_tree':
+                bayes_net = probability.prune_network(self.bayes_net, self.last_nodes, evidence_variables) if prune else self.bayes_net
+                return probability.JunctionTree(bayes_net, evidence_variables, ordering)
+            if kind == 'circuit':
+                bayes_net = probability.prune_network(self.bayes_net, self.last_nodes, evidence_variables) if prune else self.bayes_net
+                return probability.ArithmeticCircuit(bayes_net, ordering)
+            if kind == 'sampler':
+                bayes_net = self.dbn.unroll(self.readings)
+                bayes_net = probability.prune_network(bayes_net, self.last_nodes, evidence_variables) if prune else bayes_net
+                return probability.ForwardSampler(bayes_net)
+            if kind == 'loopy':
+                bayes_net = probability.prune_network(self.bayes_net, self.last_nodes, evidence_variables) if prune else self.bayes_net
+                return probability.LoopyBeliefPropagation(bayes_net, damping, schedule, max_iter=max_iterations, tol=tolerance)
+
+            plans = {}
+            for room in rooms:
+                bayes_net = probability.prune_network(self.bayes_net, room, evidence_variables) if prune else self.bayes_net
+                plans[room] = probability.EliminationPlan(room, evidence_variables, bayes_net, ordering)
+            return plans
+
+        # Twin rooms have the same probability of fire, so only the first one of each class needs an elimination plan
+        rooms = self.last_nodes
+        if kind == 'elimination' and symmetry:
+            copies = {room+'@'+self.last_nodes[0].rsplit('@', 1)[1] for twins in self.twins() for room in twins[1:]}
+            rooms = [room for room in self.last_nodes if room not in copies]
+
+        options = (damping, schedule, max_iterations, tolerance) if kind == 'loopy' else (rooms,) if kind == 'elimination' else ()
+        key = ModelCache.key(kind, self.museum, self.pattern, prune, ordering, *options)
+        return get_model_cache().get(key, build)
+
+    def estimate(self):
+        """Estimates the cost of exact inference for all the rooms at the last time instant (the elimination of the (pruned)
+        network compiled by the junction tree), from the elimination order alone. It only depends on the museum and on which
+        sensors were measured, so it is shared through the model cache.
+
+        Returns
+        -------
+        cost : dictionary
+            With the keys 'width' (induced width of the elimination order), 'entries' and 'bytes' (size of the largest table),
+            'flops' (approximate number of floating point operations) and 'seconds' (the flops at flop_rate).
+        """
+
+        evidence_variables = set(self.evidence)
+
+        def build():
+            bayes_net = probability.prune_network(self.bayes_net, self.last_nodes, evidence_variables) if prune else self.bayes_net
+            cost = probability.elimination_cost(bayes_net, evidence_variables, ordering)
+            del cost['order']
+            return cost
+
+        cost = dict(get_model_cache().get(ModelCache.key('cost', self.museum, self.pattern, prune, ordering), build))
+        cost['seconds'] = cost['flops'] / flop_rate
+        return cost
+
+    def choose_algorithm(self, cost=None):
+        """Returns the algorithm used by the 'auto' algorithm: 'junction_tree' if the estimated cost of exact inference fits
+        memory_budget and time_budget, the approximate algorithm otherwise.
+
+        Parameters
+        ----------
+        cost : dictionary
+            The cost returned by estimate() (None = estimate it).
+
+        Returns
+        -------
+        algorithm : string
+        """
+
+        if cost is None:
+            cost = self.estimate()
+        if cost['bytes'] <= memory_budget and cost['seconds'] <= time_budget:
+            return 'junction_tree'
+        return approximate
+
     def solve(self):
         """Solve the museum fire problem, that is, which room at the last time instant is more likely to be on fire.
-        The solution if obtained using the algorithm probability.elimination_ask() from the AIMA repository.
+        The solution if obtained using the algorithm selected by the module variable algorithm: variable elimination (a probability.EliminationPlan) or
+        probability.enumeration_ask() from the AIMA repository for each room, a single probability.JunctionTree calibration,
+        a single probability.ArithmeticCircuit evaluation and differentiation, likelihood weighting with a probability.ForwardSampler,
+        blocked Gibbs sampling with a probability.GibbsSampler, loopy belief propagation with a probability.LoopyBeliefPropagation,
+        or filtering over the time instants, exact with probability.FrontierFilter or approximate with probability.BoyenKollerFilter.
+        The 'auto' algorithm picks one of them with choose_algorithm().
 
         Returns
         -------
@@ -114,34 +633,571 @@ class Problem:
             The element room is a string containing the room name.
             The element likelihood is a a float which value is the probablity to be on fire.
         """
-        
-        # Calculate the probability of fire for each room in the final time instant. Store the results in a dictionary with the room name and its probability.
-        if algorithm:
-            algorithm_function = probability.enumeration_ask
-        else:
-            algorithm_function = probability.elimination_ask
 
-        results = {room.rsplit('@', 1)[0]: algorithm_function(room, self.evidence, self.bayes_net) for room in self.last_nodes}
-        
-        if debug:
-            # Print algorithm name
-            print('Algorithm: ', end='')
-            if algorithm:
-                print('enumeration_ask')
-            else:
-                print('elimination_ask')
+        results = self.marginals()
 
+        if debug:
             # Print all the rooms probabilities
             print('Results')
             for room in results:
                 print(room, '\t', results[room].show_approx())
-        
-        # Get the room with maximum probability of fire and its probability
+
+        return self.most_likely(results)
+
+    def solve_topk(self, k=1):
+        """Finds the k rooms at the last time instant most likely to be on fire, in decreasing order, without calculating the
+        probability of every room exactly. Each connected component (see split()) starts with bounds of the probability of its
+        rooms: exact for the ones with a closed form (see closed_form()), from bounds(topk_i_bound) for the others. While the ranking
+        is not certified (some room of the top k could be overtaken by a room ranked after it), only the components of the rooms
+        involved are refined, with their i-bound increased by topk_i_step. A component is solved with marginals() instead as soon as
+        bounding it would not be cheaper: when the i-bound exceeds its induced width (the bounds would be exact), when the flops of all
+        its bounding passes would exceed the ones of exact inference (see estimate()), so that it never costs much more than solving
+        it, or when the tables would be larger than memory_budget. A component whose exact inference does not fit memory_budget and
+        time_budget (see choose_algorithm()) is never solved: it is bounded while the bounding passes fit the budgets, and then keeps
+        its bounds, and the ranking is returned uncertified. The components of the rooms that are certainly out of the top k are
+        never solved.
+        Sets the attribute certified.
+
+        Parameters
+        ----------
+        k : int
+            Number of rooms.
+
+        Returns
+        -------
+        ranking : list of tuples
+            The k rooms (or all of them, if there are fewer), each one as a tuple (room, lower, upper) with the bounds of its
+            probability of fire (equal when it was solved). Rooms with the same probability are in the order of rooms, so the first
+            one is the solution of solve(). If certified is False, the bounds hold but their order is not certain.
+        """
+
+        components = self.split() if decompose else [self]
+        bounds = {room: (0.0, 1.0) for room in self.rooms}
+        i_bounds = {}
+        flops = {}
+        stuck = set()
+
+        def refine(component, i_bound):
+            # Two mini-bucket passes per room, each one with a table of up to 2**i_bound entries per variable, and an overhead of
+            # about 2**12 flops per variable (slicing the tables and partitioning the buckets)
+            cost = component.estimate()
+            passes = 2 * len(component.rooms) * len(component.bayes_net.variables) * (2**i_bound + 2**12)
+            flops[component] = flops.get(component, 0) + passes
+            bounded = i_bound <= cost['width'] and 8 * 2**i_bound <= memory_budget and passes / flop_rate <= time_budget
+            if component.choose_algorithm(cost) == 'junction_tree' and (not bounded or flops[component] >= cost['flops']):
+                results = component.marginals()
+                bounds.update((room, (results[room][True],) * 2) for room in component.rooms)
+            elif bounded:
+                bounds.update(component.bounds(i_bound))
+            else:
+                # Neither exact inference nor tighter bounds fit the budgets
+                stuck.add(component)
+                return
+            i_bounds[component] = i_bound
+            if debug:
+                print('Refined', component.rooms, 'to i-bound', i_bound)
+
+        for component in components:
+            results = component.closed_form()
+            if results is not None:
+                bounds.update((room, (results[room][True],) * 2) for room in component.rooms)
+            else:
+                refine(component, topk_i_bound)
+        position = {room: i for i, room in enumerate(self.rooms)}
+
+        while True:
+            ranking = sorted(self.rooms, key=lambda room: (-bounds[room][0], -bounds[room][1], position[room]))
+
+            # A room of the top k is certified when its lower bound is at least the upper bound of every room ranked after it
+            uncertain = set()
+            after = max((bounds[room][1] for room in ranking[k:]), default=0.0)
+            for i in reversed(range(min(k, len(ranking)))):
+                lower = bounds[ranking[i]][0]
+                if lower < after:
+                    uncertain.add(ranking[i])
+                    uncertain.update(room for room in ranking[i+1:] if bounds[room][1] > lower)
+                after = max(after, bounds[ranking[i]][1])
+
+            uncertain = [component for component in components
+                         if any(room in uncertain and bounds[room][0] < bounds[room][1] for room in component.rooms)]
+            self.certified = not uncertain
+            if all(component in stuck for component in uncertain):
+                if debug and not self.certified:
+                    print('Top', k, 'not certified: exact inference of', len(uncertain), 'component(s) does not fit the budgets')
+                return [(room,) + tuple(bounds[room]) for room in ranking[:k]]
+            for component in uncertain:
+                if component not in stuck:
+                    refine(component, i_bounds.get(component, topk_i_bound - topk_i_step) + topk_i_step)
+
+    def bounds(self, i_bound):
+        """Calculates bounds of the probability of fire of each room at the last time instant, with probability.mini_bucket_bounds()
+        on the (pruned) network, normalized by a second, lower bounding, pass (the probability of the measurements is not known).
+        The elimination order is found once, for all the rooms. Twin rooms have the same probability of fire, so only the first one
+        of each class is bounded.
+
+        Parameters
+        ----------
+        i_bound : int
+            Largest number of variables of a mini-bucket.
+
+        Returns
+        -------
+        bounds : dictionary
+            The keys are the room names and the values tuples (lower, upper) with the bounds of their probability of fire.
+        """
+
+        bayes_net = probability.prune_network(self.bayes_net, self.last_nodes, self.evidence) if prune else self.bayes_net
+        copies = {room: twins[0] for twins in self.twins() for room in twins[1:]} if symmetry else {}
+        time = self.last_nodes[0].rsplit('@', 1)[1]
+        order = probability.elimination_order(bayes_net, [X for X in bayes_net.variables if X not in self.evidence], self.evidence,
+                                              ordering)
+
+        bounds = {}
+        for room in self.rooms:
+            if room not in copies:
+                bounds[room] = probability.mini_bucket_bounds(room+'@'+time, self.evidence, bayes_net, i_bound, order)[:2]
+        return {room: bounds[copies.get(room, room)] for room in self.rooms}
+
+    def marginals(self):
+        """Calculates the probability of fire of each room at the last time instant, with the algorithm selected by the module
+        variable algorithm (see solve()). If the museum has several connected components, each one is solved on its own (see
+        solve_components()).
+
+        Returns
+        -------
+        results : dictionary
+            The keys are the room names, in the order of rooms, and the values their probability.ProbDist of fire.
+        """
+
+        components = self.split() if decompose else [self]
+        if len(components) > 1:
+            return self.solve_components(components)
+
+        # Interchangeable rooms without measurements are lumped, and the problem solved again
+        lumped, representative = self.lump() if symmetry else (self, None)
+        if lumped is not self:
+            results = lumped.marginals()
+            return {room: results[representative[room]] for room in self.rooms}
+
+        results = self.closed_form()
+        if results is not None:
+            if debug:
+                print('Algorithm: closed form')
+            return results
+
+        engine = self.choose_algorithm() if algorithm == 'auto' else algorithm
+
+        # Calculate the probability of fire for each room in the final time instant. Store the results in a dictionary with the room name and its probability.
+        if engine == 'junction_tree':
+            # A single calibration gives the marginals of all the rooms
+            tree = self.compile('junction_tree').calibrate(self.evidence)
+            results = {room.rsplit('@', 1)[0]: tree.marginal(room) for room in self.last_nodes}
+        elif engine == 'circuit':
+            # The derivatives of a single evaluation give the marginals of all the rooms
+            circuit = self.compile('circuit').differentiate(self.evidence)
+            results = {room.rsplit('@', 1)[0]: circuit.marginal(room) for room in self.last_nodes}
+        elif engine == 'sampling':
+            # The same samples, weighted by the measurements, estimate the probabilities of all the rooms
+            marginals = self.compile('sampler').marginals(self.last_nodes, self.evidence, samples)
+            results = {room.rsplit('@', 1)[0]: marginals[room] for room in self.last_nodes}
+        elif engine == 'gibbs':
+            # Fire persists, so a room is only resampled with its whole history (the spread nodes are computed, not sampled)
+            bayes_net = self.dbn.unroll(self.readings)
+            bayes_net = probability.prune_network(bayes_net, self.last_nodes, self.evidence) if prune else bayes_net
+            blocks = [[room+f'@{i}' for i in range(len(self.readings))] for room in self.rooms]
+            sampler = probability.GibbsSampler(bayes_net, self.evidence, blocks, chains).run(sweeps, burn_in)
+            results = {room.rsplit('@', 1)[0]: sampler.marginal(room) for room in self.last_nodes}
+        elif engine == 'loopy':
+            # The messages converge to approximate marginals of all the rooms at once
+            propagation = self.compile('loopy').run(self.evidence)
+            results = {room.rsplit('@', 1)[0]: propagation.marginal(room) for room in self.last_nodes}
+            if debug:
+                print('Belief propagation', 'converged' if propagation.converged else 'did not converge', 'after',
+                      propagation.iterations, 'iterations, residual', propagation.residual)
+        elif engine in ('filtering', 'factored', 'particle'):
+            results = self.run_filter(self.create_filter(engine)).marginals()
+            if engine == 'factored' and drift:
+                print('Drift', '\n', self.drift(), '\n')
+        else:
+            results = {}
+            for room, plan in self.compile('elimination').items():
+                if engine == 'enumeration':
+                    results[room.rsplit('@', 1)[0]] = probability.enumeration_ask(room, self.evidence, plan.bn, enumeration_cache > 0,
+                                                                                  enumeration_cache)
+                else:
+                    # The plan only slices the tables at the measurements and runs its contractions
+                    results[room.rsplit('@', 1)[0]] = plan.execute(self.evidence)
+            if symmetry:
+                for twins in self.twins():
+                    results.update((room, results[twins[0]]) for room in twins[1:])
+                results = {room: results[room] for room in self.rooms}
+
+        if debug:
+            # Print algorithm name
+            print('Algorithm:', algorithm if engine == algorithm else f'{algorithm} ({engine})')
+
+        return results
+
+    def closed_form(self):
+        """Calculates the probability of fire of each room at the last time instant without any Bayesian network, when the problem
+        has a closed form:
+        an isolated room (without connections) is on fire at all the time instants or at none, so its probability only depends on
+        the measurements of its own sensors (Bayes' rule);
+        without measurements, the probabilities are the prior propagated over the time instants (see spread_prior()), for
+        museums of up to closed_form_rooms rooms.
+
+        Returns
+        -------
+        results : dictionary or None
+            The keys are the room names and the values their probability.ProbDist of fire, or None if there is no closed form.
+        """
+
+        R, C, S, P, M = self.data
+        parents = self.get_parents(R, C)
+
+        if len(R) == 1 and not parents[R[0]][1:]:
+            room = R[0]
+            fire = self.per_room(self.fire_prior, room)
+            no_fire = 1 - fire
+            for readings in self.readings:
+                for sensor, measurement in readings.items():
+                    fire *= S[sensor]['TPR'] if measurement else 1 - S[sensor]['TPR']
+                    no_fire *= S[sensor]['FPR'] if measurement else 1 - S[sensor]['FPR']
+                    # Normalize as it goes, so that long histories do not underflow
+                    total = fire + no_fire
+                    fire, no_fire = (fire/total, no_fire/total) if total > 0 else (fire, no_fire)
+            return {room: probability.ProbDist(room, {True: fire, False: no_fire})}
+
+        if not self.evidence and len(R) <= closed_form_rooms:
+            return self.spread_prior(parents, P)
+
+        return None
+
+    def spread_prior(self, parents, P):
+        """Propagates the prior probability of fire over the time instants, without measurements. The joint probability of the rooms
+        is kept in an array with an axis of 3 values per room: not on fire, on fire since this time instant, and on fire since a
+        previous one. At each time instant, every room not on fire and connected to a room on fire since a previous time instant
+        catches fire with probability P; then the rooms on fire since this time instant become on fire since a previous one.
+
+        Parameters
+        ----------
+        parents : dictionary of lists
+            The connections of each room plus itself, as returned by get_parents().
+        P : float or dictionary
+            Probability of fire propagation (or a dictionary with the one of each room).
+
+        Returns
+        -------
+        results : dictionary
+            The keys are the room names and the values their probability.ProbDist of fire at the last time instant.
+        """
+
+        import numpy as np
+        from functools import reduce
+
+        R = self.rooms
+        k = len(R)
+        index = {room: i for i, room in enumerate(R)}
+        axis = lambda r, value: (slice(None),)*r + (value,)
+
+        # The rooms are independent at the first time instant
+        priors = [self.per_room(self.fire_prior, room) for room in R]
+        belief = reduce(np.multiply.outer, [np.array([1 - prior, 0, prior]) for prior in priors], np.array(1.0))
+
+        for _ in range(1, len(self.readings)):
+            for r, room in enumerate(R):
+                neighbours = {index[n] for n in parents[room][1:] if n != room}
+                if not neighbours:
+                    continue
+                # Probability moved to 'on fire since this time instant', unless no neighbour was on fire before
+                moved = self.per_room(P, room) * belief[axis(r, 0)]
+                moved[tuple(slice(0, 2) if j in neighbours else slice(None) for j in range(k) if j != r)] = 0
+                belief[axis(r, 1)] += moved
+                belief[axis(r, 0)] -= moved
+            for r in range(k):
+                belief[axis(r, 2)] += belief[axis(r, 1)]
+                belief[axis(r, 1)] = 0
+
+        results = {}
+        for r, room in enumerate(R):
+            fire = float(belief[axis(r, 2)].sum())
+            results[room] = probability.ProbDist(room, {True: fire, False: 1 - fire})
+        return results
+
+    def twins(self):
+        """Finds the classes of twin rooms: rooms with the same connections (besides each other), the same propagation probability
+        and probability of fire at the first time instant, and sensors with the same TPR, FPR and measurements. Exchanging two twin
+        rooms maps the problem to itself (it is an automorphism of the museum that preserves the sensors and the evidence), so twin
+        rooms have the same probability of fire.
+
+        Returns
+        -------
+        classes : list of lists
+            The twin classes with more than one room, each one in the order of rooms.
+        """
+
+        R, C, S, P, M = self.data
+        parents = self.get_parents(R, C)
+        connections = {room: frozenset(parents[room]) - {room} for room in R}
+
+        # What a room looks like from its own sensors (the ones never measured do not matter)
+        signature = {room: (self.per_room(P, room), self.per_room(self.fire_prior, room)) for room in R}
+        for sensor in sorted(S, key=lambda sensor: (S[sensor]['TPR'], S[sensor]['FPR'])):
+            measurements = tuple(readings.get(sensor) for readings in self.readings)
+            if any(measurement is not None for measurement in measurements):
+                signature[S[sensor]['room']] += ((S[sensor]['TPR'], S[sensor]['FPR'], measurements),)
+
+        # Twins are either not connected to each other, and then have the same connections, or connected, and then have the same
+        # connections once they are included
+        classes, found = [], set()
+        for closed in (False, True):
+            groups = {}
+            for room in R:
+                if room not in found:
+                    groups.setdefault((connections[room] | {room} if closed else connections[room], signature[room]), []).append(room)
+            for group in groups.values():
+                if len(group) > 1:
+                    classes.append(group)
+                    found.update(group)
+
+        return classes
+
+    def lump(self):
+        """Lumps the classes of three or more twin rooms without measurements (see twins()): all the rooms of a class but the
+        first one are replaced by a single aggregate room '<room>*<count>' on fire when any of them is. The other rooms only depend
+        on the class through whether any of its rooms is on fire, and the aggregate room follows the same propagation law as a room,
+        with probability of fire 1 - (1 - P_F)**count at the first time instant and propagation probability 1 - (1 - P)**count.
+        The first room stays, so its probability of fire is exact, and it is also the one of its twins.
+
+        Returns
+        -------
+        lumped : Problem
+            The lumped problem, or self if there is nothing to lump.
+        representative : dictionary
+            The keys are the room names, and the values the room of the lumped problem with the same probability of fire.
+        """
+
+        R, C, S, P, M = self.data
+        representative = {room: room for room in R}
+        unobserved = set(R) - {S[m['sensor']]['room'] for measurements in M for m in measurements}
+        classes = [c for c in self.twins() if len(c) > 2 and c[0] in unobserved]
+        if not classes:
+            return self, representative
+
+        P = {room: self.per_room(P, room) for room in R}
+        P_F = {room: self.per_room(self.fire_prior, room) for room in R}
+        aggregate = {}
+        for first, *others in classes:
+            name = f'{others[0]}*{len(others)}'
+            P[name] = 1 - (1 - P[first])**len(others)
+            P_F[name] = 1 - (1 - P_F[first])**len(others)
+            for room in others:
+                aggregate[room] = name
+                representative[room] = first
+
+        # The aggregate rooms take the place of their first room, with its connections
+        rooms = [aggregate.get(room, room) for room in R]
+        rooms = list(dict.fromkeys(rooms))
+        connections = {tuple(sorted({aggregate.get(a, a), aggregate.get(b, b)})) for a, b in C}
+        connections = [list(c) for c in sorted(connections) if len(c) == 2]
+        sensors = {sensor: data for sensor, data in S.items() if data['room'] not in aggregate}
+
+        lumped = Problem.from_data(rooms, connections, sensors, {room: P[room] for room in rooms}, M,
+                                   {room: P_F[room] for room in rooms})
+        return lumped, representative
+
+    def split(self):
+        """Splits the museum into its connected components: groups of rooms connected to each other, but not to the other rooms.
+        Fire does not spread between them, and each sensor measures a single room, so they are independent problems.
+
+        Returns
+        -------
+        components : list of Problem
+            A problem for each connected component, with its rooms, connections, sensors and measurements (in the order of rooms),
+            or [self] if the museum is connected.
+        """
+
+        R, C, S, P, M = self.data
+        parents = self.get_parents(R, C)
+
+        # Label the rooms reached from each room not yet labeled
+        component = {}
+        for room in R:
+            if room in component:
+                continue
+            component[room] = room
+            stack = [room]
+            while stack:
+                for neighbour in parents[stack.pop()]:
+                    if neighbour not in component:
+                        component[neighbour] = room
+                        stack.append(neighbour)
+
+        roots = list(dict.fromkeys(component[room] for room in R))
+        if len(roots) == 1:
+            return [self]
+
+        components = []
+        for root in roots:
+            rooms = [room for room in R if component[room] == root]
+            sensors = {sensor: data for sensor, data in S.items() if component[data['room']] == root}
+            components.append(Problem.from_data(rooms, [c for c in C if component[c[0]] == root], sensors, P,
+                                                [[m for m in measurements if m['sensor'] in sensors] for measurements in M],
+                                                self.fire_prior))
+        return components
+
+    def solve_components(self, components):
+        """Calculates the probability of fire of each room at the last time instant, solving each connected component on its own.
+        The components whose exact inference is estimated to take more than parallel_seconds are solved in a pool of worker processes,
+        if there are several of them; the others are solved in this process.
+
+        Parameters
+        ----------
+        components : list of Problem
+            The problems of the connected components, as returned by split().
+
+        Returns
+        -------
+        results : dictionary
+            The keys are the room names, in the order of rooms, and the values their probability.ProbDist of fire.
+        """
+
+        results = {}
+        # A component of a few rooms is never worth a process, and is not even estimated
+        large = [component for component in components
+                 if len(component.rooms) > 8 and component.estimate()['seconds'] > parallel_seconds]
+        if len(large) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            import os
+            with ProcessPoolExecutor(max_workers=min(len(large), os.cpu_count() or 1), initializer=init_worker,
+                                     initargs=(get_options(),)) as pool:
+                for marginals in pool.map(solve_component, [component.data + (component.fire_prior,) for component in large]):
+                    results.update(marginals)
+        else:
+            large = []
+
+        for component in components:
+            if component not in large:
+                results.update(component.marginals())
+
+        return {room: results[room] for room in self.rooms}
+
+    def most_likely(self, results):
+        """Returns the room with maximum probability of fire and its probability.
+
+        Parameters
+        ----------
+        results : dictionary
+            The keys are the rooms names and the values their probability.ProbDist of being on fire.
+
+        Returns
+        -------
+        (room, likelihood) : tuple
+            The element room is a string containing the room name.
+            The element likelihood is a a float which value is the probablity to be on fire.
+        """
+
         room = max(results.keys(), key=(lambda room: results[room][True]))
         likelihood = results[room][True]
 
         return (room, likelihood)
 
+    def create_filter(self, kind=None):
+        """Creates the filter used by the filtering algorithms, at the first time instant: probability.BoyenKollerFilter for the
+        'factored' algorithm, probability.ParticleFilter for the 'particle' algorithm and probability.FrontierFilter (exact
+        filtering) otherwise.
+
+        Parameters
+        ----------
+        kind : string
+            The filtering algorithm (None = the module variable algorithm).
+
+        Returns
+        -------
+        belief : probability.FrontierFilter, probability.BoyenKollerFilter or probability.ParticleFilter
+            Filter of the dbn.
+        """
+
+        if kind is None:
+            kind = algorithm
+        if kind == 'factored':
+            return probability.BoyenKollerFilter(self.dbn, clusters)
+        if kind == 'particle':
+            return probability.ParticleFilter(self.dbn, particles, resampling)
+        return probability.FrontierFilter(self.dbn)
+
+    def stream(self, measurements):
+        """Solves the museum fire problem online: the measurements of each time instant are folded into a filter as they arrive,
+        so the cost of each time instant does not depend on how many came before. The measurements in self.readings are used first.
+
+        Parameters
+        ----------
+        measurements : iterable of lists of dictionaries
+            The measurements of the following time instants, in the format of the elements of M returned by load_file().
+
+        Yields
+        ------
+        (time, room, likelihood) : tuple
+            After each time instant: the time instant, the room most likely to be on fire and its probability.
+        """
+
+        belief = self.create_filter()
+        readings = iter(self.readings)
+        measurements = ({m['sensor']: m['measurement'] for m in measurement} for measurement in measurements)
+
+        from itertools import chain
+        for i, reading in enumerate(chain(readings, measurements)):
+            if i:
+                belief.advance()
+            belief.observe(reading)
+            yield (i,) + self.most_likely(belief.marginals())
+
+    def run_filter(self, belief):
+        """Runs a filter over the measurements, one time instant at a time.
+
+        Parameters
+        ----------
+        belief : probability.FrontierFilter, probability.BoyenKollerFilter or probability.ParticleFilter
+            Filter of the dbn, at the first time instant.
+
+        Returns
+        -------
+        belief : probability.FrontierFilter, probability.BoyenKollerFilter or probability.ParticleFilter
+            The same filter, at the last time instant.
+        """
+
+        for i, readings in enumerate(self.readings):
+            if i:
+                belief.advance()
+            belief.observe(readings)
+
+        return belief
+
+    def drift(self):
+        """Runs the approximate and the exact filters side by side and measures how far apart their probabilities of fire are.
+        The exact filter is exponential in the number of rooms, so this is only feasible for small museums.
+
+        Returns
+        -------
+        drift : list
+            For each time instant, the largest absolute difference between the approximate and exact probability of fire of a room.
+        """
+
+        approximate = probability.BoyenKollerFilter(self.dbn, clusters)
+        exact = probability.FrontierFilter(self.dbn)
+        drift = []
+
+        for i, readings in enumerate(self.readings):
+            if i:
+                approximate.advance()
+                exact.advance()
+            approximate.observe(readings)
+            exact.observe(readings)
+            drift.append(max(abs(approximate.marginal(room)[True] - exact.marginal(room)[True]) for room in self.rooms))
+
+        return drift
+
     def load_file(self, f):
         """Loads a opened file object fh. This file has the structure given in the project statement.
 
@@ -173,41 +1229,85 @@ class Problem:
         M = []
 
         for line in f.readlines():
-            splitted = line.split()
-            if not splitted:
-                continue
-
-            code = splitted[0]
-            args = splitted[1:]
+            code, value = self.parse_line(line)
 
-            # Room
             if code == 'R':
-                R.extend(args)
-            
-            # Connection
+                R.extend(value)
             elif code == 'C':
-                C.extend([elem.split(',') for elem in args])
-
-            # Sensor
+                C.extend(value)
             elif code == 'S':
-                for sensor in args:
-                    data = sensor.split(':')
-                    S[data[0]] = {'room': data[1], 'TPR': float(data[2]), 'FPR': float(data[3])}
-
-            # Propagation probability
+                S.update(value)
             elif code == 'P':
-                P = float(args[0])
-
-            # Measurements
+                P = value
             elif code == 'M':
-                measurement = [{'sensor': sensor[0], 'measurement': str2bool(sensor[1])} for sensor in [elem.split(':') for elem in args]]
-                M.append(measurement)
-
-            else:
-                print("Unrecognized line:", line)
+                M.append(value)
 
         return R, C, S, P, M
 
+    @staticmethod
+    def parse_line(line):
+        """Parses a line of the input file.
+
+        Parameters
+        ----------
+        line : string
+            Line of the input file.
+
+        Returns
+        -------
+        (code, value) : tuple
+            The code is the first character of the line ('R', 'C', 'S', 'P' or 'M'), or None for empty and unrecognized lines.
+            The value is, according to the code, a list of room names, a list of connections, a dictionary of sensors,
+            the propagation probability or the list of measurements of a time instant, in the formats returned by load_file().
+        """
+
+        splitted = line.split()
+        if not splitted:
+            return None, None
+
+        code = splitted[0]
+        args = splitted[1:]
+
+        # Room
+        if code == 'R':
+            return code, args
+        
+        # Connection
+        elif code == 'C':
+            return code, [elem.split(',') for elem in args]
+
+        # Sensor
+        elif code == 'S':
+            S = {}
+            for sensor in args:
+                data = sensor.split(':')
+                S[data[0]] = {'room': data[1], 'TPR': float(data[2]), 'FPR': float(data[3])}
+            return code, S
+
+        # Propagation probability
+        elif code == 'P':
+            return code, float(args[0])
+
+        # Measurements
+        elif code == 'M':
+            return code, [{'sensor': sensor[0], 'measurement': str2bool(sensor[1])} for sensor in [elem.split(':') for elem in args]]
+
+        else:
+            print("Unrecognized line:", line)
+            return None, None
+
+    @staticmethod
+    def per_room(value, room):
+        """Returns the value of a room of a parameter that is either the same for all the rooms or a dictionary by room.
+
+        Parameters
+        ----------
+        value : float or dictionary
+        room : string
+        """
+
+        return value[room] if isinstance(value, dict) else value
+
     def get_parents(self, R, C):
         """Creates a dictionary where the keys are the rooms names and the values are lists of connections (including a connection with itself).
         This facilitates the generation of the Bayes network, since the parents of the room nodes are always their connections
@@ -236,51 +1336,6 @@ class Problem:
 
         return parents
 
-    def get_conditional_probabilities(self, R, P, parents):
-        """Creates a dictionary containing the room nodes conditional probabilities of fire propagation.
-        This is useful when generating the Bayes net because all the room nodes (except the ones at the first time instant) have these conditional probabilities.
-
-        Parameters
-        ----------
-        R : list
-            List containing the room names.
-        P : float
-            Propagation probability
-        parents : dictionary of lists
-            A dictionary containing the parents of each room node. The key is the room name and the value is a lists of its connections plus itself.
-
-        Returns
-        -------
-        cond_prob : dictionary of dictinaries
-            A dictionary containing the the conditional probabilities of the room nodes.
-            The keys are the room names and the values are another dictionary containing the conditional probabilities.
-            The keys of this other dictionary are the entries of the truth table as boolean lists and the values are the (conditional) probabilities of that truth table.
-        """
-
-        from itertools import product
-
-        # Initialize dictionary
-        cond_prob = {room: 0 for room in R}
-
-        for room in R:
-            # Number of columns of the truth table
-            n = len(parents[room])
-            # Generate the truth table input
-            table = list(product([False, True], repeat=n))
-            
-            # The first column corresponds to the same room in the previous time instant.
-            # The second half of that table has that column as True, which means the room was on fire and, therefore, the probability of being on fire is 1.
-            # For the other cases, the probability of being on fire is the probability of fire propagation (except the first row)
-            half = 2**(n-1)
-            prob = [P if i<half else 1 for i in range(len(table))]
-
-            # For the first row, since no room was on fire, the probability of being on fire is 0
-            prob[0] = 0
-
-            cond_prob[room] = dict(zip(table, prob))
-    
-        return cond_prob
-
     def get_sensor_probabilities(self, S):
         """Creates a dictionary containing the sensors nodes conditional probabilities of TPR and FPR. 
         This is useful when generating the Bayes net because all the sensors nodes have these conditional probabilities.
@@ -323,7 +1378,58 @@ class Problem:
 
         return evidence
 
-    def create_bayes_net(self, R, S, M, parents, cond_prob, sensor_prob, P_F):
+    def create_dynamic_bayes_net(self, R, S, P, parents, sensor_prob, P_F):
+        """Creates the dynamic Bayesian network for the museum fire problem: the nodes of the rooms at the first time instant,
+        the nodes of the rooms at a following time instant (whose parents are in the previous one), and the sensor nodes.
+
+        The fire propagation law is: a room on fire stays on fire, and a room with at least one connection on fire catches fire
+        with probability P. It is represented with noisy-OR nodes (probability.NoisyOrNode), whose size is linear in the number
+        of parents, instead of truth tables with 2^(number of connections + 1) entries. Each room '<room>' with connections has
+        an intermediate node '<room>:spread', which is true when any of its connections was on fire in the previous time instant
+        (a noisy-OR with weights 1). The room node is a noisy-OR of the room in the previous time instant (weight 1) and of
+        '<room>:spread' (weight P).
+
+        Parameters
+        ----------
+        R : list
+            List containing the room names.
+        S : dictionary of dictionaries
+            Dictionary where the keys are the sensors name. The values are dictionaries containing the keys 'room', 'TPR', and 'FPR'.
+        P : float or dictionary
+            Propagation probability (or a dictionary with the one of each room)
+        parents : dictionary of lists
+            A dictionary containing the parents of each room node. The key is the room name and the value is a lists of its connections plus itself.
+        sensor_prob : dictionary of dictinaries
+            A dictionary containing the the conditional probabilities of the sensor nodes.
+            The keys are the sensors' names and the values are another dictionary containing the FPR for False and TPR for True.
+        P_F : float or dictionary
+            Probability of fire of the rooms at the first time instant (or a dictionary with the one of each room)
+
+        Returns
+        -------
+        dbn : probability.DynamicBayesNet
+            The dynamic Bayesian network of the museum fire problem.
+        """
+
+        # Rooms at time instant 0 (and probability of fire of 50%)
+        prior = [(room, '', self.per_room(P_F, room)) for room in R]
+
+        # Rooms at the following time instants. The parents are the room and its connections at the previous time instant
+        transition = []
+        for room in R:
+            connections = parents[room][1:]
+            if connections:
+                transition.append(probability.NoisyOrNode(room+':spread', connections, 1.0))
+                transition.append(probability.NoisyOrNode(room, [room, room+':spread'], [1.0, self.per_room(P, room)]))
+            else:
+                transition.append(probability.NoisyOrNode(room, [room], 1.0))
+
+        # Sensors. The parent is the room where it is installed and the conditional probability corresponds to the FPR and TPR.
+        sensors = [(sensor, S[sensor]['room'], sensor_prob[sensor]) for sensor in S]
+
+        return probability.DynamicBayesNet(prior, transition, sensors)
+
+    def create_bayes_net(self, dbn, readings):
         """Creates the Bayesian network for the museum fire problem, as implemented in the AIMA repository.
         Each node has a unique name, where the time instant is explicited by the ending '@<time instant>'.
         For example, the room 'history' at time instant 0 will have a node named 'history@0'.
@@ -344,25 +1450,12 @@ class Problem:
 
         Parameters
         ----------
-        R : list
-            List containing the room names.
-        S : dictionary of dictionaries
-            Dictionary where the keys are the sensors name. The values are dictionaries containing the keys 'room', 'TPR', and 'FPR'.
-        M : list of lists of dictionaries
-            Each dictionary is a measurement at a given time instant where the key is the sensor name and the value the measurement.
-            All the measurements of that time (dictionaries) are stored in a list.
-            The lists of measurements at given time instants are stored in a list.
-        parents : dictionary of lists
-            A dictionary containing the parents of each room node. The key is the room name and the value is a lists of its connections plus itself.
-        cond_prob : dictionary of dictinaries
-            A dictionary containing the the conditional probabilities of the room nodes.
-            The keys are the room names and the values are another dictionary containing the conditional probabilities.
-            The keys of this other dictionary are the entries of the truth table as boolean lists and the values are the (conditional) probabilities of that truth table.
-        sensor_prob : dictionary of dictinaries
-            A dictionary containing the the conditional probabilities of the sensor nodes.
-            The keys are the sensors' names and the values are another dictionary containing the FPR for False and TPR for True.
-        P_F : float
-            Fire propagation probability
+        dbn : probability.DynamicBayesNet
+            The dynamic Bayesian network of the museum fire problem.
+        readings : list of dictionaries
+            The measurements of each time instant, as dictionaries where the key is the sensor name and the value the measurement.
+            There is a time level in the network for each time instant, and a sensor node for each measurement.
+            Noisy-OR nodes with more than two parents are decomposed (probability.decompose_noisy_or).
 
         Returns
         -------
@@ -371,34 +1464,8 @@ class Problem:
             This network will represent the museum fire problem (as illustrated above).
         """
 
-        # Initialize Bayes net
-        bayes_net = probability.BayesNet()
-
-        # Add nodes of rooms at time instant 0 (and probability of fire of 50%)
-        for room in R:
-            bayes_net.add((room+'@0', '', P_F))
-
-        # Add nodes of rooms at the following time steps (the amount of time steps correspond to the number of instants of the measurements)
-        for i in range(1, len(M)):
-            for room in R:
-                # Getting parents name at step i-1
-                parents_i = [parent+f'@{i-1}' for parent in parents[room]]
-
-                # Adding node to the net. Name is the name of the room plus @<time instant>, parents is a string of all
-                # the parents_i separated by spaces, and the conditional probability depends on the fire propagation law
-                bayes_net.add((room+f'@{i}', ' '.join(parents_i), cond_prob[room]))
-
-        # Add measurements nodes at all time steps
-        for i, measurements in enumerate(M):
-            for m in measurements:
-                # Sensor name
-                sensor = m['sensor']
-
-                # Adding node to the net. Name is the sensor name plus @<time instant>, parent is the room where
-                # it is installed plus @<time instant> and conditional probability corresponds to the FPR and TPR.
-                bayes_net.add((sensor+f'@{i}', S[sensor]['room']+f'@{i}', sensor_prob[sensor]))
-        
-        return bayes_net
+        # Rooms with many connections have spread nodes with many parents, which are divorced into chains of two-parent nodes
+        return probability.decompose_noisy_or(dbn.unroll(readings))
 
 def solver(input_file):
     """Solve the museum fire problem given a open input file object.
@@ -417,43 +1484,341 @@ def solver(input_file):
 
     return Problem(input_file).solve()
 
+def stream_solver(lines):
+    """Solve the museum fire problem online, given the lines of an input file as they arrive (from a pipe or a file being written).
+    The rooms, connections, sensors and propagation probability are read once; measurement lines are buffered until they are all
+    known, and then each one updates the solution without rebuilding anything. So a solution can only follow each measurement line
+    if the P line comes before the first M line: with the P line last, as in the input files of the assignment, nothing is yielded
+    until it is read.
+
+    Parameters
+    ----------
+    lines : iterable of strings
+        Lines of the input file.
+
+    Yields
+    ------
+    (time, room, likelihood) : tuple
+        After each measurement line: the time instant, the room most likely to be on fire and its probability.
+
+    Examples
+    --------
+    With the P line first, the solution of a measurement is yielded before the next line is read:
+
+    >>> lines = iter(['R R01 R02', 'C R01,R02', 'S S01:R01:0.9:0.1', 'P 0.3', 'M S01:T', 'M S01:F'])
+    >>> solutions = stream_solver(lines)
+    >>> next(solutions)
+    (0, 'R01', 0.9)
+    >>> next(lines)
+    'M S01:F'
+    """
+
+    lines = iter(lines)
+    R, C, S, P = [], [], {}, None
+    pending = []
+
+    def measurements():
+        # Measurements received so far, then the following ones as they arrive
+        while pending:
+            yield pending.pop(0)
+        for line in lines:
+            code, value = Problem.parse_line(line)
+            if code == 'M':
+                yield value
+            elif code is not None:
+                raise ValueError("Line received after the measurements started: " + line.strip())
+
+    for line in lines:
+        code, value = Problem.parse_line(line)
+        if code == 'R':
+            R.extend(value)
+        elif code == 'C':
+            C.extend(value)
+        elif code == 'S':
+            S.update(value)
+        elif code == 'P':
+            P = value
+        elif code == 'M':
+            pending.append(value)
+
+        # The measurements can only be used once the museum is known
+        if pending and R and P is not None:
+            yield from Problem.from_data(R, C, S, P, []).stream(measurements())
+            return
+
+def follow(f, interval=0.5):
+    """Yields the lines of an open file object, and then the lines appended to it as they are written, like tail -f. Never returns.
+
+    Parameters
+    ----------
+    f : file
+        Opened file object.
+    interval : float
+        Time in seconds between checks for new lines.
+    """
+
+    import time
+
+    line = ''
+    while True:
+        line += f.readline()
+        if line.endswith('\n'):
+            yield line
+            line = ''
+        else:
+            time.sleep(interval)
+
+def solve_file(in_filename):
+    """Solves the museum fire problem of an input file and saves the solution in the output directory, as the main program does.
+
+    Parameters
+    ----------
+    in_filename : string
+        Input file name.
+
+    Returns
+    -------
+    (in_filename, sol, elapsed) : tuple
+        The input file name, the solution (room, likelihood) and the time in seconds taken to solve it and save it.
+    """
+
+    import time
+
+    start = time.perf_counter()
+    with open(in_filename, 'r') as f:
+        sol = solver(f)
+
+    # Save solution as '<room> <likelihood>'
+    with open(get_out_filename(in_filename), 'w') as f:
+        f.write(f'{sol[0]} {sol[1]}')
+        f.write('\n')
+
+    return in_filename, sol, time.perf_counter() - start
+
+def estimate_file(in_filename):
+    """Estimates the cost of exact inference for an input file, without solving it, and the algorithm 'auto' would use.
+
+    Parameters
+    ----------
+    in_filename : string
+        Input file name.
+
+    Returns
+    -------
+    estimate : string
+        '<file>: width <w>, largest table <entries> entries (<bytes>), <flops> flops (~<seconds> s) -> <algorithm>'.
+    """
+
+    with open(in_filename, 'r') as f:
+        problem = Problem(f)
+    cost = problem.estimate()
+
+    return (f"{in_filename}: width {cost['width']}, largest table {cost['entries']} entries ({cost['bytes']/2**20:.3g} MiB), "
+            f"{cost['flops']:.3g} flops (~{cost['seconds']:.3g} s) -> {problem.choose_algorithm(cost)}")
+
+def solve_component(data):
+    """Calculates the probability of fire of each room of a connected component, in a worker process of Problem.solve_components.
+
+    Parameters
+    ----------
+    data : tuple
+        The input variables (R, C, S, P, M) and the probability of fire at the first time instant P_F of the component.
+
+    Returns
+    -------
+    results : dictionary
+        The keys are the room names and the values their probability.ProbDist of fire.
+    """
+
+    return Problem.from_data(*data).marginals()
+
+def get_options():
+    """Returns a snapshot of the module options (see option_names), to be passed to init_worker.
+
+    Returns
+    -------
+    options : dictionary
+        The keys are the options names and the values their current values.
+    """
+
+    return {name: globals()[name] for name in option_names}
+
+def init_worker(options):
+    """Sets the module options in a worker process of solve_components or batch_solver (which, under the spawn or forkserver start
+    methods, does not inherit the ones set by the main program).
+
+    Parameters
+    ----------
+    options : dictionary
+        Snapshot of the module options of the main program, returned by get_options().
+    """
+
+    global parallel_seconds
+    globals().update(options)
+
+    # The workers are already in parallel, so they do not start processes of their own
+    parallel_seconds = float('inf')
+
+def batch_files(pattern):
+    """Returns the sorted list of input files given by a directory (all its .txt files) or a glob pattern (e.g. public_tests/*.txt).
+    Files without a line of rooms (like the solutions.txt of the tests) are not problems, and are skipped.
+
+    Parameters
+    ----------
+    pattern : string
+        Directory or glob pattern.
+
+    Returns
+    -------
+    filenames : list of strings
+    """
+
+    import glob
+    import os.path
+
+    def is_problem(filename):
+        with open(filename, 'r') as f:
+            return any(line.split()[:1] == ['R'] for line in f)
+
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.txt')
+    return sorted(f for f in glob.glob(pattern) if os.path.isfile(f) and is_problem(f))
+
+def batch_solver(filenames, workers=None, show=False):
+    """Solves many input files in a pool of worker processes, so that the interpreter start and the imports are paid once per
+    worker instead of once per file. Each solution is saved in the output directory, as the main program does.
+
+    Parameters
+    ----------
+    filenames : list of strings
+        Input file names.
+    workers : int
+        Number of worker processes (None = number of CPUs).
+    show : boolean
+        Boolean variable to print each solution as it is done.
+
+    Returns
+    -------
+    results : list of tuples
+        (in_filename, sol, elapsed) for each file, in the order they finished, as returned by solve_file.
+    wall : float
+        Total time in seconds.
+    """
+
+    import time
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(get_options(),)) as pool:
+        futures = {pool.submit(solve_file, f): f for f in filenames}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as error:
+                # A bad file must not stop the others
+                print(f'{futures[future]}: {type(error).__name__}: {error}')
+                continue
+            if show:
+                in_filename, sol, elapsed = results[-1]
+                print(in_filename, *sol)
+
+    return results, time.perf_counter() - start
+
+def batch_summary(results, wall, total):
+    """Returns the throughput and latency summary of batch_solver, as a string.
+
+    Parameters
+    ----------
+    results : list of tuples
+        (in_filename, sol, elapsed) for each file solved.
+    wall : float
+        Total time in seconds.
+    total : int
+        Number of files given (the ones missing from results failed).
+    """
+
+    latencies = sorted(elapsed for _, _, elapsed in results)
+    n = len(latencies)
+    lines = [f'Solved {n} of {total} files in {wall:.3f} s ({n/wall if wall else 0:.1f} files/s)']
+    if n:
+        percentile = lambda q: latencies[min(n-1, int(q*n))]
+        lines.append(f'Latency (s): mean {sum(latencies)/n:.4f}  p50 {percentile(0.5):.4f}  p95 {percentile(0.95):.4f}  '
+                     f'max {latencies[-1]:.4f}')
+    return '\n'.join(lines)
+
 def read_argv():
     """Processes the arguments given through argv. If the input filename isn't given, the program exits.
+    The positional arguments are <input file> <print bool> <algorithm> <debug>, and the options are described in the help (-h).
 
     Returns:
     --------
-    in_filename : string
-        Input file name as given thorugh argv.
-    show : boolean
-        Boolean variable to show to print the result in stdout.
-    algorithm_bool : boolean
-        Boolean variable to choose algorithm
-    debug_bool : boolean
-        Boolean variable to show debug prints
+    args : argparse.Namespace
+        With the attributes:
+        in_filename : string
+            Input file name as given thorugh argv ('-' for the standard input).
+        show : boolean
+            Boolean variable to show to print the result in stdout.
+        algorithm : string
+            Name of the inference algorithm (one of algorithms)
+        debug : boolean
+            Boolean variable to show debug prints
+        stream : boolean
+            Boolean variable to print the solution after every measurement line
+        follow : boolean
+            Boolean variable to keep reading the lines appended to the input file
+        batch : boolean
+            Boolean variable to solve all the files of a directory or glob pattern given as input file
+        workers : int
+            Number of worker processes in batch mode (None = number of CPUs)
+        cache_dir : string
+            Directory of the on-disk tier of the model cache (None = memory only)
+        dry_run : boolean
+            Boolean variable to only print the estimated cost of exact inference of the input file(s), without solving them
+        top : int
+            Number of rooms to print, most likely to be on fire first, with the bounds of their probability (None = solve normally)
     """
 
+    import argparse
     from sys import argv, exit
-    
-    l = len(argv)
-    show = False
-    algorithm_bool = False
-    debug_bool = False
-
-    if l==1:
-        print(argv[0]+" <input file> <print bool> <algorithm:0=elimination,1=enumeration> <debug>")
+
+    parser = argparse.ArgumentParser(description="The museum is on fire!")
+    parser.add_argument('in_filename', metavar='input file',
+                        help="input file ('-' reads it from the standard input, in stream mode; "
+                             "a directory or a quoted glob pattern like 'public_tests/*.txt' solves all the files, in batch mode)")
+    parser.add_argument('show', metavar='print bool', nargs='?', type=str2bool, default=False, help="print the solution")
+    parser.add_argument('algorithm', nargs='?', type=str2algorithm, default=algorithm,
+                        help="|".join(algorithms)+" (0=elimination,1=enumeration)")
+    parser.add_argument('debug', nargs='?', type=str2bool, default=False, help="show debug prints")
+    parser.add_argument('--stream', action='store_true',
+                        help="print '<time> <room> <likelihood>' after every measurement line, using a filtering algorithm "
+                             "(the P line must come before the M lines, otherwise nothing is printed until it is read)")
+    parser.add_argument('--follow', action='store_true',
+                        help="in stream mode, keep waiting for lines appended to the input file (like tail -f); "
+                             "the writer must write the P line before the M lines")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of worker processes in batch mode (default: number of CPUs)")
+    parser.add_argument('--cache-dir', default=None,
+                        help="directory where compiled models are saved, to be reused by later runs on the same museum")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="only print the estimated cost of exact inference of the input file(s), and the algorithm 'auto' "
+                             "would use")
+    parser.add_argument('--top', type=int, default=None, metavar='K',
+                        help="only print the K rooms most likely to be on fire, as '<room> <lower> <upper>' bounds of their "
+                             "probability, solving exactly only the rooms needed to rank them")
+
+    if len(argv)==1:
+        parser.print_usage()
         exit(0)
-    elif l>=3:
-        show = str2bool(argv[2])
-        
-        if l>=4:
-            algorithm_bool = str2bool(argv[3])
 
-            if l>=5:
-                debug_bool = str2bool(argv[4])
+    args = parser.parse_args()
+    args.stream = args.stream or args.follow or args.in_filename == '-'
 
-    in_filename = argv[1]
+    import glob
+    import os.path
+    args.batch = not args.stream and (os.path.isdir(args.in_filename) or glob.has_magic(args.in_filename))
 
-    return in_filename, show, algorithm_bool, debug_bool
+    return args
 
 def get_out_filename(in_filename):
     """Receives a filename and returns the string "output/<filename>". Works in every operating system
@@ -484,11 +1849,64 @@ def str2bool(string):
 
     return string.lower() in ("yes", "y", "true", "t", "1")
 
+def str2algorithm(string):
+    """Converts a string to an algorithm name. Besides the names in algorithms, the old boolean flag values are accepted
+    (false selects 'elimination' and true selects 'enumeration').
+
+    Parameters:
+    -----------
+    string : string
+    """
+
+    if string in algorithms:
+        return string
+    if string.lower() in ("no", "n", "false", "f", "0"):
+        return 'elimination'
+    if str2bool(string):
+        return 'enumeration'
+    raise ValueError(f"Unknown algorithm: {string}")
+
 
 if __name__ == '__main__':
-    # Get input file name, show flag, and algorithm flag
-    in_filename, show, algorithm, debug = read_argv()
-    
+    # Get input file name, show flag, algorithm flag and modes
+    args = read_argv()
+    in_filename, show, algorithm, debug, cache_dir = args.in_filename, args.show, args.algorithm, args.debug, args.cache_dir
+
+    import sys
+
+    if args.stream:
+        # Only the filtering algorithms update the solution incrementally
+        if algorithm not in ('filtering', 'factored', 'particle'):
+            algorithm = 'filtering'
+
+        f = sys.stdin if in_filename == '-' else open(in_filename, 'r')
+        lines = follow(f) if args.follow else f
+
+        # Print the solution after each measurement line
+        for sol in stream_solver(lines):
+            print(*sol, flush=True)
+        sys.exit(0)
+
+    if args.dry_run:
+        # Print the estimates, without solving anything
+        for filename in batch_files(in_filename) if args.batch else [in_filename]:
+            print(estimate_file(filename))
+        sys.exit(0)
+
+    if args.top is not None:
+        # Print the ranking, without saving a solution
+        with open(in_filename, 'r') as f:
+            for sol in Problem(f).solve_topk(args.top):
+                print(*sol)
+        sys.exit(0)
+
+    if args.batch:
+        # Solve all the files in a pool of processes, then print the throughput and latency
+        filenames = batch_files(in_filename)
+        results, wall = batch_solver(filenames, args.workers, show)
+        print(batch_summary(results, wall, len(filenames)))
+        sys.exit(0 if len(results) == len(filenames) else 1)
+
     # Open file and solve museum fire problem
     with open(in_filename, 'r') as f:
         sol = solver(f)
@@ -504,4 +1922,3 @@ if __name__ == '__main__':
     with open(out_filename, 'w') as f:
         f.write(f'{sol[0]} {sol[1]}')
         f.write('\n')
-
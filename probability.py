@@ -2,8 +2,10 @@
 Probability models. (Chapter 13-15)
 """
 
+import copy
+import heapq
 import random
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from functools import reduce
 
 import numpy as np
@@ -134,6 +136,39 @@ def event_values(event, variables):
         return tuple([event[var] for var in variables])
 
 
+def event_mask(event, variables):
+    """Return the values of variables in event packed into an int bitmask, the
+    first variable being the most significant bit (so a mask is also the flat
+    index of the values in a table with an axis per variable, in C order).
+    >>> event_mask(dict(A=T, B=F, C=T), ['C', 'B', 'A'])
+    5
+    >>> event_mask((True, True), ['C', 'A'])
+    3
+    """
+    mask = 0
+    for value in event_values(event, variables):
+        mask = (mask << 1) | bool(value)
+    return mask
+
+
+def mask_values(mask, n):
+    """Return the n boolean values packed in mask (see event_mask).
+    >>> mask_values(5, 3)
+    (True, False, True)
+    """
+    return tuple(bool(mask >> (n - 1 - i) & 1) for i in range(n))
+
+
+def mask_array(masks, n):
+    """Return the values packed in each of masks as a boolean array with a row
+    per mask and a column per variable (see event_mask).
+    >>> mask_array(np.arange(4), 2).astype(int).tolist()
+    [[0, 0], [0, 1], [1, 0], [1, 1]]
+    """
+    shifts = np.arange(n - 1, -1, -1, dtype=np.uint64)
+    return ((np.asarray(masks, dtype=np.uint64)[:, None] >> shifts) & np.uint64(1)).astype(bool)
+
+
 # ______________________________________________________________________________
 
 
@@ -175,34 +210,63 @@ class BayesNet:
         """Nodes must be ordered with parents before children."""
         self.nodes = []
         self.variables = []
+        # name -> node and name -> position in self.nodes (a topological index)
+        self.variable_nodes = {}
+        self.variable_indices = {}
         node_specs = node_specs or []
         for node_spec in node_specs:
             self.add(node_spec)
 
     def add(self, node_spec):
         """Add a node to the net. Its parents must already be in the
-        net, and its variable must not."""
-        node = BayesNode(*node_spec)
-        assert node.variable not in self.variables
-        assert all((parent in self.variables) for parent in node.parents)
+        net, and its variable must not. node_spec is either the arguments
+        of BayesNode or a new node (of any BayesNode subclass)."""
+        node = node_spec if isinstance(node_spec, BayesNode) else BayesNode(*node_spec)
+        assert node.variable not in self.variable_nodes
+        assert all((parent in self.variable_nodes) for parent in node.parents)
+        node.index = len(self.nodes)
         self.nodes.append(node)
         self.variables.append(node.variable)
+        self.variable_nodes[node.variable] = node
+        self.variable_indices[node.variable] = node.index
         for parent in node.parents:
-            self.variable_node(parent).children.append(node)
+            self.variable_nodes[parent].children.append(node)
 
     def variable_node(self, var):
         """Return the node for the variable named var.
         >>> burglary.variable_node('Burglary').variable
         'Burglary'"""
-        for n in self.nodes:
-            if n.variable == var:
-                return n
-        raise Exception("No such variable: {}".format(var))
+        try:
+            return self.variable_nodes[var]
+        except KeyError:
+            raise Exception("No such variable: {}".format(var))
+
+    def variable_index(self, var):
+        """Return the position of var in a topological order of the net.
+        >>> burglary.variable_index('Alarm')
+        2"""
+        try:
+            return self.variable_indices[var]
+        except KeyError:
+            raise Exception("No such variable: {}".format(var))
 
     def variable_values(self, var):
         """Return the domain of var."""
         return [True, False]
 
+    def compile(self):
+        """Return the net as an immutable CompiledBayesNet, with int variables
+        and flat CPT arrays."""
+        return CompiledBayesNet(self)
+
+    def __setstate__(self, state):
+        """Unpickle the net, linking again the nodes to their children (see
+        BayesNode.__getstate__)."""
+        self.__dict__.update(state)
+        for node in self.nodes:
+            for parent in node.parents:
+                self.variable_nodes[parent].children.append(node)
+
     def __repr__(self):
         return 'BayesNet({0!r})'.format(self.nodes)
 
@@ -348,6 +412,8 @@ class BayesNode:
         self.parents = parents
         self.cpt = cpt
         self.children = []
+        self.index = None
+        self._table = None
 
     def p(self, value, event):
         """Return the conditional probability
@@ -368,11 +434,241 @@ class BayesNode:
         parents."""
         return probability(self.p(True, event))
 
+    def relabel(self, X, parents):
+        """Return a copy of this node, not yet in any net, for the variable X
+        with the given parents (standing for the current ones, in order)."""
+        node = copy.copy(self)
+        node.variable = X
+        node.parents = list(parents)
+        node.children = []
+        node.index = None
+        return node
+
+    def __getstate__(self):
+        """Pickle the node without its children, which the net links again:
+        following them would recurse through the whole net."""
+        state = dict(self.__dict__)
+        state['children'] = []
+        return state
+
+    def table(self):
+        """Return the CPT as an ndarray P[x, parent1, parent2, ...] with one
+        boolean axis per variable (index 0 for False, 1 for True)."""
+        if self._table is None:
+            ptrue = np.zeros(2 ** len(self.parents))
+            for vs, p in self.cpt.items():
+                ptrue[event_mask(vs, self.parents)] = p
+            ptrue = ptrue.reshape((2,) * len(self.parents))
+            self._table = np.stack([1 - ptrue, ptrue])
+        return self._table
+
     def __repr__(self):
         #return repr((self.variable, ' '.join(self.parents)))
         return repr((self.variable, ' '.join(self.parents), self.cpt))
 
 
+class NoisyOrNode(BayesNode):
+    """A boolean variable whose parents are independent causes [Section 14.3]:
+    each true parent i makes X true unless inhibited, with probability
+    weights[i] of not being inhibited, and X can also be true because of a
+    leak. Storage is linear in the number of parents.
+    >>> X = NoisyOrNode('Fever', 'Cold Flu Malaria', [0.4, 0.8, 0.9])
+    >>> round(X.p(True, dict(Cold=T, Flu=F, Malaria=T)), 3)
+    0.94
+    """
+
+    def __init__(self, X, parents, weights, leak=0.0):
+        """weights is a sequence with one probability per parent, or a single
+        probability shared by all of them."""
+        if isinstance(parents, str):
+            parents = parents.split()
+        if isinstance(weights, (float, int)):
+            weights = [weights] * len(parents)
+
+        assert len(weights) == len(parents)
+        assert all(0 <= w <= 1 for w in weights) and 0 <= leak <= 1
+
+        self.variable = X
+        self.parents = parents
+        self.weights = tuple(weights)
+        self.leak = leak
+        self.children = []
+        self.index = None
+        self._table = None
+
+    @property
+    def cpt(self):
+        """The equivalent table {(v1, v2, ...): P(X=true | parents)}, which
+        has 2**len(parents) entries."""
+        ptrue = self.table()[1].ravel()
+        return {mask_values(mask, len(self.parents)): float(ptrue[mask]) for mask in range(len(ptrue))}
+
+    def p(self, value, event):
+        """Return the conditional probability P(X=value | parents=parent_values)."""
+        assert isinstance(value, bool)
+        pfalse = 1 - self.leak
+        for w, Y in zip(self.weights, self.parents):
+            if event[Y]:
+                pfalse *= 1 - w
+        return 1 - pfalse if value else pfalse
+
+    def table(self):
+        """Return the CPT as an ndarray P[x, parent1, parent2, ...] (see BayesNode.table)."""
+        if self._table is None:
+            self._table = noisy_or_table(self.weights, self.leak)
+        return self._table
+
+    def __repr__(self):
+        return repr((self.variable, ' '.join(self.parents), self.weights, self.leak))
+
+
+def noisy_or_table(weights, leak):
+    """Return the CPT of a noisy-OR node with the given weights and leak as an
+    ndarray P[x, parent1, parent2, ...], which has 2**(len(weights) + 1) entries."""
+    pfalse = reduce(np.multiply.outer, [np.array([1, 1 - w]) for w in weights], np.array(1 - leak))
+    return np.stack([pfalse, 1 - pfalse])
+
+
+def decompose_noisy_or(bn):
+    """Return a BayesNet equivalent to bn where every NoisyOrNode with more than
+    two parents is divorced from them: a chain of two-parent noisy-OR nodes
+    named X~1, X~2, ... accumulates the causes, so no factor of the node
+    spans more than three variables.
+    >>> bn = BayesNet([('A', '', 0.5), ('B', '', 0.5), ('C', '', 0.5), NoisyOrNode('X', 'A B C', 0.5, 0.1)])
+    >>> decompose_noisy_or(bn).variables
+    ['A', 'B', 'C', 'X~1', 'X']
+    >>> elimination_ask('A', dict(X=T), decompose_noisy_or(bn)).show_approx()
+    'False: 0.398, True: 0.602'
+    >>> elimination_ask('A', dict(X=T), bn).show_approx()
+    'False: 0.398, True: 0.602'
+    """
+    result = BayesNet()
+    for node in bn.nodes:
+        if not isinstance(node, NoisyOrNode) or len(node.parents) <= 2:
+            result.add(node.relabel(node.variable, node.parents))
+            continue
+        # The last parent joins the cause accumulated from all the others
+        previous, weight = node.parents[0], node.weights[0]
+        for i, (Y, w) in enumerate(zip(node.parents[1:-1], node.weights[1:-1])):
+            name = '{}~{}'.format(node.variable, i + 1)
+            result.add(NoisyOrNode(name, [previous, Y], [weight, w]))
+            previous, weight = name, 1.0
+        result.add(NoisyOrNode(node.variable, [previous, node.parents[-1]], [weight, node.weights[-1]], node.leak))
+    return result
+
+
+# ______________________________________________________________________________
+# Compiled networks
+
+
+class CompiledNode:
+    """A node of a CompiledBayesNet: the variable, its position and those of
+    its parents and children as tuples of ints, and its CPT as a flat float64
+    array of P(X=true | parents), indexed by the bitmask of the parents'
+    values (the first parent being the most significant bit, as in
+    BayesNode.table). Noisy-OR nodes keep their weights and leak instead, and
+    their cpt is None: their table has 2**len(parents) entries, so it is only
+    built by table() for the engines that need it. Nodes have __slots__ and
+    their CPTs are read-only views of a single array of the net, so a compiled
+    net is small and cannot change."""
+
+    __slots__ = ('variable', 'index', 'parents', 'children', 'cpt', 'weights', 'leak')
+
+    def __init__(self, variable, index, parents, cpt, weights=None, leak=0.0):
+        self.variable = variable
+        self.index = index
+        self.parents = tuple(parents)
+        self.children = ()
+        self.cpt = cpt
+        self.weights = weights
+        self.leak = leak
+        assert (self.weights is not None) if self.cpt is None else len(self.cpt) == 2 ** len(self.parents)
+
+    def mask(self, values):
+        """Return the bitmask of the parents' values in values, a sequence of
+        0/1 values indexed by variable position."""
+        mask = 0
+        for j in self.parents:
+            mask = (mask << 1) | values[j]
+        return mask
+
+    def p(self, value, mask):
+        """Return P(X=value | parents=mask)."""
+        if self.cpt is None:
+            pfalse = 1 - self.leak
+            for k, w in enumerate(reversed(self.weights)):
+                if mask >> k & 1:
+                    pfalse *= 1 - w
+            ptrue = 1 - pfalse
+        else:
+            ptrue = float(self.cpt[mask])
+        return ptrue if value else 1 - ptrue
+
+    def table(self):
+        """Return the CPT as an ndarray P[x, parent1, parent2, ...] (see BayesNode.table)."""
+        if self.cpt is None:
+            return noisy_or_table(self.weights, self.leak)
+        return np.stack([1 - self.cpt, self.cpt]).reshape((2,) * (len(self.parents) + 1))
+
+    def __repr__(self):
+        return 'CompiledNode({!r}, {}, {})'.format(self.variable, self.index, self.parents)
+
+
+class CompiledBayesNet:
+    """An immutable BayesNet where variables are the ints 0, 1, ... of a
+    topological order, for the engines that work on arrays: made by
+    BayesNet.compile, with a CompiledNode per variable.
+    >>> net = burglary.compile()
+    >>> net.variable_index('Alarm'), net.nodes[2].parents, net.nodes[2].children
+    (2, (0, 1), (3, 4))
+    >>> net.nodes[2].p(True, 0b10)
+    0.94
+    >>> net = BayesNet([('A', '', 0.5), ('B', '', 0.5), NoisyOrNode('X', 'A B', [0.4, 0.8], 0.1)]).compile()
+    >>> net.nodes[2].cpt is None, round(net.nodes[2].p(True, 0b10), 3), net.nodes[2].table()[1].round(3)
+    (True, 0.46, array([[0.1  , 0.82 ],
+           [0.46 , 0.892]]))
+    """
+
+    __slots__ = ('variables', 'indices', 'nodes', 'cpt')
+
+    def __init__(self, bn):
+        self.variables = tuple(bn.variables)
+        self.indices = dict(bn.variable_indices)
+        # The CPTs of all the nodes but the noisy-OR ones, one after the other
+        tables = [node for node in bn.nodes if not isinstance(node, NoisyOrNode)]
+        self.cpt = np.concatenate([node.table()[1].ravel() for node in tables] or [np.empty(0)])
+        self.cpt.flags.writeable = False
+        nodes, start = [], 0
+        for node in bn.nodes:
+            parents = [self.indices[Y] for Y in node.parents]
+            if isinstance(node, NoisyOrNode):
+                nodes.append(CompiledNode(node.variable, node.index, parents, None, node.weights, node.leak))
+            else:
+                cpt = self.cpt[start:start + 2 ** len(parents)]
+                start += len(cpt)
+                nodes.append(CompiledNode(node.variable, node.index, parents, cpt))
+        children = [[] for _ in nodes]
+        for node in nodes:
+            for j in node.parents:
+                children[j].append(node.index)
+        for node, c in zip(nodes, children):
+            node.children = tuple(c)
+        self.nodes = tuple(nodes)
+
+    def variable_index(self, var):
+        """Return the int of the variable named var."""
+        try:
+            return self.indices[var]
+        except KeyError:
+            raise Exception("No such variable: {}".format(var))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __repr__(self):
+        return 'CompiledBayesNet({!r})'.format(self.nodes)
+
+
 # Burglary example [Figure 14.2]
 
 T, F = True, False
@@ -389,15 +685,18 @@ burglary = BayesNet([
 # ______________________________________________________________________________
 
 
-def enumeration_ask(X, e, bn):
+def enumeration_ask(X, e, bn, memoized=False, cache_size=2 ** 16):
     """
     [Figure 14.9]
     Return the conditional probability distribution of variable X
-    given evidence e, from BayesNet bn.
+    given evidence e, from BayesNet bn. memoized enumerates with a
+    MemoizedEnumeration, caching at most cache_size sub-sums.
     >>> enumeration_ask('Burglary', dict(JohnCalls=T, MaryCalls=T), burglary
     ...  ).show_approx()
     'False: 0.716, True: 0.284'"""
     assert X not in e, "Query variable must be distinct from evidence"
+    if memoized:
+        return MemoizedEnumeration(bn, cache_size).ask(X, e)
     Q = ProbDist(X)
     for xi in bn.variable_values(X):
         Q[xi] = enumerate_all(bn.variables, extend(e, X, xi), bn)
@@ -420,23 +719,203 @@ def enumerate_all(variables, e, bn):
                    for y in bn.variable_values(Y))
 
 
+class MemoizedEnumeration:
+    """Exact inference by enumeration [Figure 14.9] that reuses identical
+    sub-sums. The sum over the variables from position i of the topological
+    order on depends only on the values of the frontier: the earlier,
+    non-evidence variables that are parents of variable i or later ones.
+    So each sub-sum is cached under its position and the bitmask of the
+    frontier's values, in an LRU cache of at most cache_size entries. The
+    assignment is a single list of 0/1 values, set and undone in place as
+    the recursion goes, and each CPT a flat list indexed by the bitmask of
+    the parents.
+    >>> enumerator = MemoizedEnumeration(burglary)
+    >>> enumerator.ask('Burglary', dict(JohnCalls=T, MaryCalls=T)).show_approx()
+    'False: 0.716, True: 0.284'
+    >>> enumerator.ask('Alarm', dict(JohnCalls=T, MaryCalls=F)).show_approx()
+    'False: 0.986, True: 0.0136'
+    """
+
+    def __init__(self, bn, cache_size=2 ** 16):
+        self.bn = bn
+        self.cache_size = cache_size
+        self.variables = list(bn.variables)
+        net = bn.compile()
+        self.parents = [list(node.parents) for node in net.nodes]
+        self.tables = [node.table().ravel().tolist() for node in net.nodes]
+        # last[j] is the last position that reads variable j (itself or a child)
+        self.last = list(range(len(self.variables)))
+        for i, parents in enumerate(self.parents):
+            for j in parents:
+                self.last[j] = max(self.last[j], i)
+        self.cache = OrderedDict()
+        self.query = None
+        self.hits = self.misses = 0
+
+    def ask(self, X, e):
+        """Return P(X | e). The cache is only kept for the same query."""
+        assert X not in e, "Query variable must be distinct from evidence"
+        n = len(self.variables)
+        self.values = [None] * n
+        self.domains = [(0, 1)] * n
+        for Y, y in e.items():
+            if Y in self.bn.variable_indices:
+                i = self.bn.variable_index(Y)
+                self.values[i] = int(y)
+                self.domains[i] = (int(y),)
+        if self.query != (X, e):
+            self.query = (X, dict(e))
+            self.cache.clear()
+
+        # The query is fixed in turn to each value: the sums before its
+        # position depend on it too, so it is in all their frontiers
+        q = self.bn.variable_index(X)
+        self.frontiers, frontier = [], []
+        for i in range(n):
+            frontier = [j for j in frontier if self.last[j] >= i]
+            if i and self.last[i - 1] >= i and len(self.domains[i - 1]) > 1:
+                frontier.append(i - 1)
+            self.frontiers.append(tuple(frontier) + ((q,) if i <= q else ()))
+
+        Q = ProbDist(X)
+        for x in self.bn.variable_values(X):
+            self.values[q] = int(x)
+            self.domains[q] = (int(x),)
+            Q[x] = self.suffix(0)
+        return Q.normalize()
+
+    def suffix(self, i):
+        """Return the sum over the variables from position i on of the product
+        of their CPT entries, for the values of those before."""
+        if i == len(self.variables):
+            return 1.0
+        values = self.values
+        mask = 0
+        for j in self.frontiers[i]:
+            mask = (mask << 1) | values[j]
+        key = (i, mask)
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.misses += 1
+
+        table = self.tables[i]
+        base = 0
+        for j in self.parents[i]:
+            base = (base << 1) | values[j]
+        half = len(table) // 2
+        domain = self.domains[i]
+        total = 0.0
+        for v in domain:
+            values[i] = v
+            p = table[v * half + base]
+            if p:
+                total += p * self.suffix(i + 1)
+        if len(domain) > 1:
+            values[i] = None  # undo
+
+        self.cache[key] = total
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return total
+
+
 # ______________________________________________________________________________
 
 
-def elimination_ask(X, e, bn):
+def elimination_ask(X, e, bn, order='min_fill'):
     """
     [Figure 14.11]
-    Compute bn's P(X|e) by variable elimination.
+    Compute bn's P(X|e) by variable elimination. The hidden variables are
+    summed out in the given order (see elimination_order). To run the same
+    query for many evidence values, compile an EliminationPlan once.
     >>> elimination_ask('Burglary', dict(JohnCalls=T, MaryCalls=T), burglary
     ...  ).show_approx()
+    'False: 0.716, True: 0.284'
+    >>> elimination_ask('Burglary', dict(JohnCalls=T, MaryCalls=T), burglary, 'reverse'
+    ...  ).show_approx()
     'False: 0.716, True: 0.284'"""
-    assert X not in e, "Query variable must be distinct from evidence"
-    factors = []
-    for var in reversed(bn.variables):
-        factors.append(make_factor(var, e, bn))
-        if is_hidden(var, X, e):
-            factors = sum_out(var, factors, bn)
-    return pointwise_product(factors, bn).normalize()
+    return EliminationPlan(X, e, bn, order).execute(e)
+
+
+class EliminationPlan:
+    """Variable elimination for P(X|e) compiled once for bn, the query
+    variable X and a set of evidence variables, and then executed for any
+    values of them. Compiling does all the graph work: the elimination order,
+    which factors each step multiplies, and the einsum subscripts of every
+    contraction. execute(e) only slices the CPT tables at the evidence values
+    and runs the contractions.
+    >>> plan = EliminationPlan('Burglary', ['JohnCalls', 'MaryCalls'], burglary)
+    >>> plan.execute(dict(JohnCalls=T, MaryCalls=T)).show_approx()
+    'False: 0.716, True: 0.284'
+    >>> plan.execute(dict(JohnCalls=T, MaryCalls=F)).show_approx()
+    'False: 0.995, True: 0.00513'
+    """
+
+    def __init__(self, X, evidence_variables, bn, order='min_fill'):
+        evidence_variables = set(evidence_variables)
+        assert X not in evidence_variables, "Query variable must be distinct from evidence"
+        self.X = X
+        self.bn = bn
+        self.evidence_variables = evidence_variables
+
+        # Slot i holds a factor: first one per node, then one per step.
+        # Each node's table is sliced at the values of its evidence axes.
+        self.tables = []
+        scopes = []
+        for node in bn.nodes:
+            scope = [node.variable] + node.parents
+            self.tables.append((node.table(), [(i, Y) for i, Y in enumerate(scope) if Y in evidence_variables]))
+            scopes.append([Y for Y in scope if Y not in evidence_variables])
+
+        hidden = [var for var in bn.variables if is_hidden(var, X, evidence_variables)]
+        self.order = elimination_order(bn, hidden, evidence_variables, order)
+        self.steps = []
+        pending = list(range(len(scopes)))
+        for var in self.order:
+            group = [i for i in pending if var in scopes[i]]
+            pending = [i for i in pending if var not in scopes[i]]
+            variables = []
+            for i in group:
+                variables.extend(Y for Y in scopes[i] if Y != var and Y not in variables)
+            pending.append(self.add_step(group, variables, scopes))
+        self.result = self.add_step(pending, [X], scopes)
+
+    def add_step(self, group, variables, scopes):
+        """Add the steps multiplying the factors in the slots of group and
+        summing out every variable not in variables (as sum_product does).
+        Return the slot of the result."""
+        while len(group) > 32:
+            head, group = group[:31], group[31:]
+            needed = set(variables).union(*(scopes[i] for i in group))
+            kept = []
+            for i in head:
+                kept.extend(Y for Y in scopes[i] if Y in needed and Y not in kept)
+            group = [self.add_step(head, kept, scopes)] + group
+        labels = {}
+        subscripts = [[labels.setdefault(Y, len(labels)) for Y in scopes[i]] for i in group]
+        self.steps.append((list(zip(group, subscripts)), [labels[Y] for Y in variables]))
+        scopes.append(list(variables))
+        return len(scopes) - 1
+
+    def execute(self, e):
+        """Return P(X | e), where e gives values to the compiled evidence
+        variables."""
+        values = []
+        for table, axes in self.tables:
+            index = [slice(None)] * table.ndim
+            for axis, E in axes:
+                index[axis] = int(e[E])
+            values.append(table[tuple(index)])
+        for operands, output in self.steps:
+            arguments = []
+            for i, subscripts in operands:
+                arguments.append(values[i])
+                arguments.append(subscripts)
+                values[i] = None  # every factor is used by a single step
+            values.append(np.einsum(*arguments, output))
+        return Factor([self.X], values[self.result]).normalize()
 
 
 def is_hidden(var, X, e):
@@ -449,14 +928,18 @@ def make_factor(var, e, bn):
     That is, bn's full joint distribution, projected to accord with e,
     is the pointwise product of these factors for bn's variables."""
     node = bn.variable_node(var)
-    variables = [X for X in [var] + node.parents if X not in e]
-    cpt = {event_values(e1, variables): node.p(e1[var], e1)
-           for e1 in all_events(variables, bn, e)}
-    return Factor(variables, cpt)
+    scope = [var] + node.parents
+    variables = [X for X in scope if X not in e]
+    # Evidence variables are fixed by indexing their axis, the others are kept whole
+    index = tuple(int(e[X]) if X in e else slice(None) for X in scope)
+    return Factor(variables, node.table()[index])
 
 
 def pointwise_product(factors, bn):
-    return reduce(lambda f, g: f.pointwise_product(g, bn), factors)
+    variables = []
+    for f in factors:
+        variables.extend(X for X in f.variables if X not in variables)
+    return sum_product(factors, variables)
 
 
 def sum_out(var, factors, bn):
@@ -464,38 +947,60 @@ def sum_out(var, factors, bn):
     result, var_factors = [], []
     for f in factors:
         (var_factors if var in f.variables else result).append(f)
-    result.append(pointwise_product(var_factors, bn).sum_out(var, bn))
+    variables = []
+    for f in var_factors:
+        variables.extend(X for X in f.variables if X != var and X not in variables)
+    result.append(sum_product(var_factors, variables))
     return result
 
 
+def sum_product(factors, variables):
+    """Multiply factors together and sum out every variable not in variables,
+    returning a Factor over variables (in that order). Done in one einsum, so
+    the product is never materialized over the summed-out variables."""
+    # einsum takes a limited number of operands, so contract the excess first,
+    # keeping only the variables still needed by the others or the result
+    while len(factors) > 32:
+        head, factors = factors[:31], factors[31:]
+        needed = set(variables).union(*(f.variables for f in factors))
+        kept = []
+        for f in head:
+            kept.extend(X for X in f.variables if X in needed and X not in kept)
+        factors = [sum_product(head, kept)] + factors
+    labels = {}
+    operands = []
+    for f in factors:
+        operands.append(f.cpt)
+        operands.append([labels.setdefault(X, len(labels)) for X in f.variables])
+    return Factor(list(variables), np.einsum(*operands, [labels[X] for X in variables]))
+
+
 class Factor:
-    """A factor in a joint distribution."""
+    """A factor in a joint distribution. The table cpt is an ndarray with one
+    boolean axis per variable, indexed 0 for False and 1 for True."""
 
     def __init__(self, variables, cpt):
         self.variables = variables
-        self.cpt = cpt
+        self.cpt = np.asarray(cpt, dtype=float)
 
     def pointwise_product(self, other, bn):
         """Multiply two factors, combining their variables."""
-        variables = list(set(self.variables) | set(other.variables))
-        cpt = {event_values(e, variables): self.p(e) * other.p(e) for e in all_events(variables, bn, {})}
-        return Factor(variables, cpt)
+        variables = self.variables + [X for X in other.variables if X not in self.variables]
+        return sum_product([self, other], variables)
 
     def sum_out(self, var, bn):
         """Make a factor eliminating var by summing over its values."""
         variables = [X for X in self.variables if X != var]
-        cpt = {event_values(e, variables): sum(self.p(extend(e, var, val)) for val in bn.variable_values(var))
-               for e in all_events(variables, bn, {})}
-        return Factor(variables, cpt)
+        return Factor(variables, self.cpt.sum(axis=self.variables.index(var)))
 
     def normalize(self):
         """Return my probabilities; must be down to one variable."""
         assert len(self.variables) == 1
-        return ProbDist(self.variables[0], {k: v for ((k,), v) in self.cpt.items()})
+        return ProbDist(self.variables[0], {True: float(self.cpt[1]), False: float(self.cpt[0])})
 
     def p(self, e):
         """Look up my value tabulated for e."""
-        return self.cpt[event_values(e, self.variables)]
+        return float(self.cpt[tuple(int(e[X]) for X in self.variables)])
 
 
 def all_events(variables, bn, e):
@@ -509,6 +1014,552 @@ def all_events(variables, bn, e):
                 yield extend(e1, X, x)
 
 
+# ______________________________________________________________________________
+# Elimination orderings
+
+
+def interaction_graph(bn, e):
+    """Return the moralized interaction graph of bn once evidence e is fixed,
+    as a dict {var: set of neighbours} over bn's non-evidence variables. Two
+    variables are neighbours when they appear together in a factor of bn."""
+    graph = {var: set() for var in bn.variables if var not in e}
+    for node in bn.nodes:
+        scope = [X for X in [node.variable] + node.parents if X not in e]
+        for X in scope:
+            graph[X].update(Y for Y in scope if Y != X)
+    return graph
+
+
+def min_degree(graph, var, weights):
+    """Number of neighbours of var: eliminating it creates a factor over them."""
+    return len(graph[var])
+
+
+def min_fill(graph, var, weights):
+    """Number of edges that eliminating var would add between its neighbours."""
+    neighbours = list(graph[var])
+    return sum(1 for i, Y in enumerate(neighbours) for Z in neighbours[i + 1:] if Z not in graph[Y])
+
+
+def weighted_min_fill(graph, var, weights):
+    """Like min_fill, but each fill edge counts the product of the domain
+    sizes (weights) of its two endpoints."""
+    neighbours = list(graph[var])
+    return sum(weights[Y] * weights[Z] for i, Y in enumerate(neighbours) for Z in neighbours[i + 1:]
+               if Z not in graph[Y])
+
+
+ELIMINATION_HEURISTICS = {'min_degree': min_degree, 'min_fill': min_fill, 'weighted_min_fill': weighted_min_fill}
+
+
+def elimination_order(bn, variables, e, order='min_fill'):
+    """Return the order in which to eliminate variables from bn given evidence e.
+    order is either 'reverse' (reverse topological order, as in [Figure 14.11]),
+    the name of a heuristic in ELIMINATION_HEURISTICS, a heuristic function
+    h(graph, var, weights), or an explicit sequence of variables.
+    Heuristics are applied greedily on the interaction graph, always eliminating
+    the variable of lowest score, and breaking ties by position in bn.
+    >>> elimination_order(burglary, ['Burglary', 'Earthquake', 'Alarm'], {})
+    ['Burglary', 'Earthquake', 'Alarm']"""
+    if order == 'reverse':
+        return [var for var in reversed(bn.variables) if var in variables]
+    if isinstance(order, str):
+        order = ELIMINATION_HEURISTICS[order]
+    elif not callable(order):
+        return list(order)
+    heuristic = order
+
+    graph = interaction_graph(bn, e)
+    weights = {var: len(bn.variable_values(var)) for var in graph}
+    rank = bn.variable_indices
+    pending = set(variables)
+    score = {var: heuristic(graph, var, weights) for var in variables}
+    heap = [(score[var], rank[var], var) for var in variables]
+    heapq.heapify(heap)
+
+    result = []
+    while heap:
+        s, _, var = heapq.heappop(heap)
+        if var not in pending or s != score[var]:
+            continue  # stale heap entry
+        pending.remove(var)
+        result.append(var)
+        # Eliminating var connects all its neighbours
+        neighbours = graph.pop(var)
+        for Y in neighbours:
+            graph[Y].discard(var)
+            graph[Y].update(Z for Z in neighbours if Z != Y)
+        # Only the neighbours and their neighbours can have a different score now
+        affected = set(neighbours)
+        for Y in neighbours:
+            affected.update(graph[Y])
+        for Y in affected & pending:
+            s = heuristic(graph, Y, weights)
+            if s != score[Y]:
+                score[Y] = s
+                heapq.heappush(heap, (s, rank[Y], Y))
+    return result
+
+
+def elimination_cost(bn, e, order='min_fill', variables=None):
+    """Estimate the cost of eliminating variables (default: all but the
+    evidence) from bn given evidence e (values or just variables), without
+    building any table. Returns a dict with the elimination order, its
+    induced width (the largest number of other variables a factor is joined
+    with), the entries and bytes (float64) of the largest factor created,
+    and the approximate number of flops: a multiplication per factor and
+    entry of each product, and an addition per entry summed out.
+    >>> cost = elimination_cost(burglary, dict(JohnCalls=T, MaryCalls=T))
+    >>> cost['width'], cost['entries'], cost['bytes'], cost['flops']
+    (2, 8, 64, 30)
+    """
+    if variables is None:
+        variables = [X for X in bn.variables if X not in e]
+    elimination = elimination_order(bn, variables, e, order)
+    size = {X: len(bn.variable_values(X)) for X in bn.variables}
+
+    # The variables of the factors left, and the factors of each variable
+    scopes = [{X for X in [node.variable] + node.parents if X not in e} for node in bn.nodes]
+    factors = defaultdict(set)
+    for i, scope in enumerate(scopes):
+        for X in scope:
+            factors[X].add(i)
+
+    width = entries = flops = 0
+    for var in elimination:
+        joined = factors.pop(var, set())
+        scope = set().union(*(scopes[i] for i in joined)) | {var}
+        table = product(size[X] for X in scope)
+        width = max(width, len(scope) - 1)
+        entries = max(entries, table)
+        flops += table * max(len(joined) - 1, 0) + table
+        scope.discard(var)
+        scopes.append(scope)
+        for X in scope:
+            factors[X] -= joined
+            factors[X].add(len(scopes) - 1)
+    return dict(order=elimination, width=width, entries=entries, bytes=8 * entries, flops=flops)
+
+
+# ______________________________________________________________________________
+# Mini-bucket bounds
+
+
+def mini_bucket(bn, e, variables, i_bound=None, order='min_fill', bound=np.max):
+    """Eliminate variables from the product of bn's factors given e, by
+    mini-bucket elimination [Dechter and Rish, 2003]. The factors of each
+    bucket are split greedily into mini-buckets of at most i_bound variables
+    (None: never split); the first one sums out the variable as usual, the
+    others bound it out instead: bound=np.max gives an upper bound of the
+    exact sum, bound=np.min a lower bound, since every factor is nonnegative.
+    Returns the Factor over the variables left and whether no bucket had to
+    be split (the factor is then exact).
+    >>> f, exact = mini_bucket(burglary, dict(JohnCalls=T, MaryCalls=T),
+    ...                        ['Earthquake', 'Alarm'], i_bound=2)
+    >>> f.variables, exact, f.cpt.round(5)
+    (['Burglary'], False, array([0.18363, 0.00119]))
+    >>> f, exact = mini_bucket(burglary, dict(JohnCalls=T, MaryCalls=T), ['Earthquake', 'Alarm'])
+    >>> exact, f.cpt.round(5)
+    (True, array([0.00149, 0.00059]))
+    """
+    factors = [make_factor(X, e, bn) for X in bn.variables]
+    exact = True
+    for var in elimination_order(bn, variables, e, order):
+        bucket = [f for f in factors if var in f.variables]
+        factors = [f for f in factors if var not in f.variables]
+        # First fit, largest scopes first; a factor too large on its own gets its own mini-bucket
+        minis = []
+        for f in sorted(bucket, key=lambda f: -len(f.variables)):
+            for scope, group in minis:
+                if i_bound is None or len(set(scope) | set(f.variables)) <= i_bound:
+                    scope.extend(X for X in f.variables if X not in scope)
+                    group.append(f)
+                    break
+            else:
+                minis.append((list(f.variables), [f]))
+        exact = exact and len(minis) <= 1
+        for k, (scope, group) in enumerate(minis):
+            kept = [X for X in scope if X != var]
+            if k == 0:
+                factors.append(sum_product(group, kept))
+            else:
+                factors.append(Factor(kept, bound(sum_product(group, [var] + kept).cpt, axis=0)))
+    variables = []
+    for f in factors:
+        variables.extend(X for X in f.variables if X not in variables)
+    return sum_product(factors, variables), exact
+
+
+def mini_bucket_bounds(X, e, bn, i_bound, order='min_fill', evidence=None):
+    """Return bounds (lower, upper, exact) of P(X=true | e), for a boolean X,
+    from mini-bucket elimination of the hidden variables with the given
+    i_bound. The upper bounds of P(X, e) are normalized by evidence, the
+    probability P(e) when known (the same for every query, so worth computing
+    once), or else by lower bounds of P(X, e) from a second pass. An explicit
+    order may include X and the evidence, which are skipped, so the order of
+    all the variables can be computed once for many queries.
+    >>> [round(p, 5) for p in mini_bucket_bounds('Burglary', dict(JohnCalls=T, MaryCalls=T), burglary, 2)[:2]]
+    [1e-05, 0.76355]
+    >>> pe = mini_bucket(burglary, dict(JohnCalls=T, MaryCalls=T), burglary.variables[:3])[0].cpt
+    >>> [round(p, 5) for p in mini_bucket_bounds('Burglary', dict(JohnCalls=T, MaryCalls=T), burglary, 2, evidence=pe)[:2]]
+    [0.0, 0.57021]
+    >>> [round(p, 5) for p in mini_bucket_bounds('Burglary', dict(JohnCalls=T, MaryCalls=T), burglary, 3)[:2]]
+    [0.28417, 0.28417]
+    """
+    hidden = [var for var in bn.variables if is_hidden(var, X, e)]
+    order = [var for var in elimination_order(bn, hidden, e, order) if is_hidden(var, X, e)]
+    upper, exact = mini_bucket(bn, e, hidden, i_bound, order, np.max)
+    u0, u1 = (float(p) for p in upper.cpt)
+    if exact:
+        p = u1 / (u0 + u1)
+        return p, p, True
+    if evidence is not None:
+        evidence = float(evidence)
+        return max(0.0, 1 - u0 / evidence), min(1.0, u1 / evidence), False
+    lower, _ = mini_bucket(bn, e, hidden, i_bound, order, np.min)
+    l0, l1 = (float(p) for p in lower.cpt)
+    return (l1 / (l1 + u0) if l1 > 0 else 0.0), (u1 / (u1 + l0) if u1 > 0 else 0.0), False
+
+
+# ______________________________________________________________________________
+# Pruning irrelevant nodes
+
+
+def prune_network(bn, query, e):
+    """Return a smaller BayesNet giving the same P(query | e) as bn, where
+    query is a variable or a list of variables:
+    * barren nodes (those that are not ancestors of the query or evidence
+      variables) are removed;
+    * so are the nodes d-separated from the query by the evidence, that is,
+      not connected to it in the moral graph of the ancestors once the
+      evidence variables are taken out;
+    * evidence variables are kept with their CPT when some of their parents
+      are kept; an evidence variable only needed as the parent of a kept node
+      becomes a root, since its own CPT is then a constant.
+    Only the evidence variables are used, not their values (e may also be a
+    set of variables), so the result can be reused for any values of them.
+    >>> prune_network(burglary, 'JohnCalls', dict(Alarm=T)).variables
+    ['Alarm', 'JohnCalls']
+    >>> prune_network(burglary, 'Burglary', dict(JohnCalls=T)).variables
+    ['Burglary', 'Earthquake', 'Alarm', 'JohnCalls']
+    """
+    query = [query] if isinstance(query, str) else list(query)
+    assert not any(X in e for X in query), "Query variables must be distinct from evidence"
+
+    # Ancestors of the query and evidence variables
+    ancestors = set()
+    stack = query + list(e)
+    while stack:
+        X = stack.pop()
+        if X not in ancestors:
+            ancestors.add(X)
+            stack.extend(bn.variable_node(X).parents)
+
+    # Moral graph of the ancestors, without the evidence variables
+    neighbours = defaultdict(set)
+    for X in ancestors:
+        scope = [Y for Y in [X] + bn.variable_node(X).parents if Y not in e]
+        for Y in scope:
+            neighbours[Y].update(scope)
+
+    # Variables connected to the query
+    connected = set()
+    stack = list(query)
+    while stack:
+        X = stack.pop()
+        if X not in connected:
+            connected.add(X)
+            stack.extend(neighbours[X])
+
+    # Nodes kept with their CPT, and nodes only kept as their parents
+    kept = connected | {E for E in ancestors if E in e and any(Y in connected for Y in bn.variable_node(E).parents)}
+    needed = set(kept)
+    for X in kept:
+        needed.update(bn.variable_node(X).parents)
+
+    pruned = BayesNet()
+    for node in bn.nodes:
+        X = node.variable
+        if X in kept:
+            pruned.add(node.relabel(X, node.parents))
+        elif X in needed:
+            pruned.add((X, '', 0.5))
+    return pruned
+
+
+# ______________________________________________________________________________
+# Junction trees
+
+
+class JunctionTree:
+    """A junction (clique) tree for a BayesNet, compiled once for a given set of
+    evidence variables. calibrate(e) absorbs values for them and runs a two-pass
+    (collect/distribute) message schedule, after which the posterior of every
+    non-evidence variable can be read off without further elimination.
+    >>> jt = JunctionTree(burglary, ['JohnCalls', 'MaryCalls'])
+    >>> jt.calibrate(dict(JohnCalls=T, MaryCalls=T)).marginal('Burglary').show_approx()
+    'False: 0.716, True: 0.284'
+    >>> jt.marginal('Alarm').show_approx()
+    'False: 0.239, True: 0.761'
+    """
+
+    def __init__(self, bn, evidence_variables, order='min_fill'):
+        self.bn = bn
+        self.evidence_variables = set(evidence_variables)
+        variables = [var for var in bn.variables if var not in self.evidence_variables]
+        order = elimination_order(bn, variables, self.evidence_variables, order)
+        self.position = {var: i for i, var in enumerate(order)}
+
+        # Simulate the elimination: eliminating the i-th variable creates clique i,
+        # made of it and its current neighbours, all eliminated later. The parent
+        # of clique i is the clique of the first of those neighbours to go.
+        graph = interaction_graph(bn, self.evidence_variables)
+        self.cliques, self.parents = [], []
+        for var in order:
+            neighbours = sorted(graph.pop(var), key=self.position.get)
+            for Y in neighbours:
+                graph[Y].discard(var)
+                graph[Y].update(Z for Z in neighbours if Z != Y)
+            self.cliques.append([var] + neighbours)
+            self.parents.append(self.position[neighbours[0]] if neighbours else None)
+        self.children = [[] for _ in self.cliques]
+        for i, parent in enumerate(self.parents):
+            if parent is not None:
+                self.children[parent].append(i)
+
+        # A node's factor goes to the clique of the first variable of its scope
+        # to be eliminated, which contains the whole scope. Factors with no
+        # variable left are constants and do not change the posteriors.
+        self.assigned = [[] for _ in self.cliques]
+        for node in bn.nodes:
+            scope = [X for X in [node.variable] + node.parents if X not in self.evidence_variables]
+            if scope:
+                self.assigned[min(self.position[X] for X in scope)].append(node.variable)
+        self.beliefs = None
+
+    def calibrate(self, e):
+        """Absorb the evidence e (values for exactly the compiled evidence
+        variables) and compute every clique's belief. Returns self."""
+        assert set(e) == self.evidence_variables, "Evidence must match the compiled evidence variables"
+        factors = [[make_factor(var, e, self.bn) for var in assigned] for assigned in self.assigned]
+
+        # Collect: children have lower indices than their parents
+        up = [None] * len(self.cliques)
+        for i, clique in enumerate(self.cliques):
+            message = sum_product(factors[i] + [up[c] for c in self.children[i]], clique[1:])
+            up[i] = Factor(message.variables, message.cpt / message.cpt.sum())
+
+        # Distribute: the message to a child is the clique belief on their
+        # separator divided by what the child sent
+        self.beliefs = [None] * len(self.cliques)
+        down = [None] * len(self.cliques)
+        for i in reversed(range(len(self.cliques))):
+            incoming = factors[i] + [up[c] for c in self.children[i]]
+            if down[i] is not None:
+                incoming.append(down[i])
+            belief = sum_product(incoming, self.cliques[i])
+            self.beliefs[i] = belief
+            for c in self.children[i]:
+                separator = sum_product([belief], up[c].variables).cpt
+                message = np.divide(separator, up[c].cpt, out=np.zeros_like(separator), where=up[c].cpt != 0)
+                down[c] = Factor(up[c].variables, message / message.sum())
+        return self
+
+    def marginal(self, X):
+        """Return P(X | e) for the evidence of the last calibration."""
+        assert X not in self.evidence_variables, "Query variable must be distinct from evidence"
+        # X is the first variable of its own clique
+        belief = self.beliefs[self.position[X]]
+        return Factor([X], belief.cpt.reshape(2, -1).sum(axis=1)).normalize()
+
+    def marginals(self, variables=None):
+        """Return a dict {X: P(X | e)} for variables (default: all non-evidence variables)."""
+        if variables is None:
+            variables = self.position
+        return {X: self.marginal(X) for X in variables}
+
+
+def junction_tree_ask(X, e, bn, order='min_fill'):
+    """Compute bn's P(X|e) by calibrating a junction tree.
+    >>> junction_tree_ask('Burglary', dict(JohnCalls=T, MaryCalls=T), burglary
+    ...  ).show_approx()
+    'False: 0.716, True: 0.284'"""
+    return JunctionTree(bn, e, order).calibrate(e).marginal(X)
+
+
+# ______________________________________________________________________________
+# Arithmetic circuits
+
+
+class ArithmeticCircuit:
+    """The network polynomial of a BayesNet compiled into an arithmetic
+    circuit: a DAG of sum and product nodes whose leaves are the CPT
+    parameters and an evidence indicator per value of every variable. It is
+    built by running variable elimination symbolically (each factor entry is
+    a circuit node), and stored as flat arrays: a product and a sum layer per
+    elimination step, each an array of the node ids of its children, so
+    evaluate(e) is one vectorized sweep giving P(e). Each layer is scaled by
+    its largest value, keeping the logarithm of its scale apart, so P(e) does
+    not underflow on long horizons (log_likelihood keeps log P(e)).
+    differentiate(e) adds a backward sweep of the derivatives of P(e), kept
+    as flows d * v / P(e) (v the value of a node, d the derivative with
+    respect to it), which do not depend on the scales. At the indicators they
+    give P(X=x | e) for every variable X at once [Darwiche, 2003].
+    >>> ac = ArithmeticCircuit(burglary)
+    >>> round(ac.evaluate(dict(JohnCalls=T, MaryCalls=T)), 6)
+    0.002084
+    >>> ac.differentiate(dict(JohnCalls=T, MaryCalls=T)).marginal('Burglary').show_approx()
+    'False: 0.716, True: 0.284'
+    >>> ac.marginal('Alarm').show_approx()
+    'False: 0.239, True: 0.761'
+
+    With 1200 readings P(e) is far below the smallest float:
+    >>> readings = BayesNet([('A', '', 0.5)] + [('E%d' % i, 'A', {T: 0.5005, F: 0.5}) for i in range(1200)])
+    >>> ac = ArithmeticCircuit(readings).differentiate({'E%d' % i: T for i in range(1200)})
+    >>> round(ac.log_likelihood, 3), ac.marginal('A').show_approx()
+    (-831.007, 'False: 0.232, True: 0.768')
+    """
+
+    def __init__(self, bn, order='min_fill', max_size=2 ** 25):
+        """max_size bounds the number of nodes and edges: the circuit grows
+        like the tables of the elimination, exponentially in its width."""
+        self.bn = bn
+        self.max_size = max_size
+        self.edges = 0
+        self.variables = list(bn.variables)
+        self.position = {X: i for i, X in enumerate(self.variables)}
+        self.layers = []
+        self.starts = []
+
+        # Leaves: the indicators of X=False and X=True for every variable X,
+        # then the parameters of every CPT table
+        self.size = 2 * len(self.variables)
+        factors = [([X], np.array([2 * i, 2 * i + 1])) for i, X in enumerate(self.variables)]
+        parameters = []
+        for node in bn.nodes:
+            table = node.table()
+            factors.append(([node.variable] + node.parents, np.arange(self.size, self.size + table.size).reshape(table.shape)))
+            parameters.append(table.ravel())
+            self.size += table.size
+        self.parameters = np.concatenate(parameters)
+
+        for var in elimination_order(bn, self.variables, {}, order):
+            group = [f for f in factors if var in f[0]]
+            factors = [f for f in factors if var not in f[0]]
+            factors.append(self.sum_out(var, self.multiply(group)))
+        self.root = int(self.multiply(factors)[1])
+        self.root_layer = int(np.searchsorted(self.starts, self.root, side='right')) - 1
+        self.values = self.flows = self.scales = None
+        self.log_likelihood = None
+
+    def add_layer(self, operation, children):
+        """Add a layer of nodes applying operation (np.add or np.multiply) to
+        the rows of children; return their ids. The layer keeps children
+        transposed, one row per operand, so each operand is contiguous. When
+        a node is a child of several nodes of the layer, the backward sweep
+        adds up their contributions with the inverse index of its distinct
+        children, found here once. Each operand comes from a single factor, so
+        from a single layer (or the leaves, -1), kept to combine the scales."""
+        self.edges += children.size
+        if self.size + len(children) + self.edges > self.max_size:
+            raise MemoryError("Arithmetic circuit larger than {} nodes and edges".format(self.max_size))
+        children = np.ascontiguousarray(children.T)
+        sources = np.searchsorted(self.starts, children[:, 0], side='right') - 1
+        distinct, inverse = np.unique(children, return_inverse=True)
+        if len(distinct) == children.size:
+            distinct = inverse = None
+        self.layers.append((operation, self.size, children, sources, distinct, inverse))
+        self.starts.append(self.size)
+        self.size += children.shape[1]
+        return np.arange(self.size - children.shape[1], self.size)
+
+    def multiply(self, factors):
+        """Return the factor (variables, node ids) of the product of factors."""
+        if len(factors) == 1:
+            return factors[0]
+        variables = []
+        for vs, _ in factors:
+            variables.extend(X for X in vs if X not in variables)
+        shape = (2,) * len(variables)
+        columns = []
+        for vs, ids in factors:
+            ids = ids.transpose([vs.index(X) for X in variables if X in vs])
+            columns.append(np.broadcast_to(ids.reshape([2 if X in vs else 1 for X in variables]), shape).ravel())
+        return variables, self.add_layer(np.multiply, np.stack(columns, axis=1)).reshape(shape)
+
+    def sum_out(self, var, factor):
+        """Return the factor (variables, node ids) summing var out of factor."""
+        vs, ids = factor
+        children = np.moveaxis(ids, vs.index(var), -1).reshape(-1, 2)
+        return [X for X in vs if X != var], self.add_layer(np.add, children).reshape((2,) * (len(vs) - 1))
+
+    def evaluate(self, e):
+        """Return P(e), keeping the scaled value of every node and the scale
+        of every layer for differentiate."""
+        values = np.empty(self.size)
+        indicators = values[:2 * len(self.variables)]
+        indicators[:] = 1
+        for X, x in e.items():
+            indicators[2 * self.position[X] + (not x)] = 0
+        values[len(indicators):len(indicators) + len(self.parameters)] = self.parameters
+        scales = np.zeros(len(self.layers))
+        for k, (operation, start, children, sources, _, _) in enumerate(self.layers):
+            layer = operation.reduce(values[children], axis=0)
+            # A product multiplies the scales of its operands, a sum has the one of its (two) operands
+            known = sources[sources >= 0]
+            scale = scales[known].sum() if operation is np.multiply else scales[known[:1]].sum()
+            peak = layer.max(initial=0)
+            if peak > 0:
+                layer /= peak
+                scale += np.log(peak)
+            values[start:start + children.shape[1]] = layer
+            scales[k] = scale
+        self.values = values
+        self.scales = scales
+        with np.errstate(divide='ignore'):
+            self.log_likelihood = float(np.log(values[self.root]) + (scales[self.root_layer] if self.root_layer >= 0 else 0))
+        return float(np.exp(self.log_likelihood))
+
+    def differentiate(self, e):
+        """Evaluate the circuit for e and compute the flow d * v / P(e) of
+        every node, from the root down: a product passes its flow to each of
+        its children (d of a child is d of the product times the other
+        children), and a sum passes it in proportion to the values of its
+        children. Returns self."""
+        self.evaluate(e)
+        values, scales = self.values, self.scales
+        flows = np.zeros(self.size)
+        flows[self.root] = 1
+        for k in reversed(range(len(self.layers))):
+            operation, start, children, sources, distinct, inverse = self.layers[k]
+            outer = flows[start:start + children.shape[1]]
+            if operation is np.add:
+                # The children's values at the scale of the sum: at most its value
+                source = scales[sources[0]] if sources[0] >= 0 else 0
+                share = values[children] * np.exp(source - scales[k])
+                total = values[start:start + children.shape[1]]
+                contributions = outer * np.divide(share, total, out=np.zeros_like(share), where=total > 0)
+            else:
+                contributions = np.broadcast_to(outer, children.shape)
+            if distinct is None:
+                flows[children] += contributions
+            else:
+                flows[distinct] += np.bincount(inverse.ravel(), contributions.ravel(), len(distinct))
+        self.flows = flows
+        return self
+
+    def marginal(self, X):
+        """Return P(X | e) for the evidence of the last differentiation."""
+        i = 2 * self.position[X]
+        return Factor([X], self.flows[i:i + 2]).normalize()
+
+    def marginals(self, variables=None):
+        """Return a dict {X: P(X | e)} for variables (default: all)."""
+        if variables is None:
+            variables = self.variables
+        return {X: self.marginal(X) for X in variables}
+
+
 # ______________________________________________________________________________
 
 # [Figure 14.12a]: sprinkler network
@@ -539,18 +1590,21 @@ def prior_sample(bn):
 # _________________________________________________________________________
 
 
-def rejection_sampling(X, e, bn, N=10000):
+def rejection_sampling(X, e, bn, N=10000, vectorized=False):
     """
     [Figure 14.14]
     Estimate the probability distribution of variable X given
     evidence e in BayesNet bn, using N samples.
     Raises a ZeroDivisionError if all the N samples are rejected,
-    i.e., inconsistent with e.
+    i.e., inconsistent with e. With vectorized=True the samples are
+    drawn all at once by a ForwardSampler.
     >>> random.seed(47)
     >>> rejection_sampling('Burglary', dict(JohnCalls=T, MaryCalls=T),
     ...   burglary, 10000).show_approx()
     'False: 0.7, True: 0.3'
     """
+    if vectorized:
+        return ForwardSampler(bn).ask(X, e, N, rejection=True)
     counts = {x: 0 for x in bn.variable_values(X)}  # bold N in [Figure 14.14]
     for j in range(N):
         sample = prior_sample(bn)  # boldface x in [Figure 14.14]
@@ -567,16 +1621,19 @@ def consistent_with(event, evidence):
 # _________________________________________________________________________
 
 
-def likelihood_weighting(X, e, bn, N=10000):
+def likelihood_weighting(X, e, bn, N=10000, vectorized=False):
     """
     [Figure 14.15]
     Estimate the probability distribution of variable X given
-    evidence e in BayesNet bn.
+    evidence e in BayesNet bn. With vectorized=True the samples are
+    drawn all at once by a ForwardSampler.
     >>> random.seed(1017)
     >>> likelihood_weighting('Burglary', dict(JohnCalls=T, MaryCalls=T),
     ...   burglary, 10000).show_approx()
     'False: 0.702, True: 0.298'
     """
+    if vectorized:
+        return ForwardSampler(bn).ask(X, e, N)
     W = {x: 0 for x in bn.variable_values(X)}
     for j in range(N):
         sample, weight = weighted_sample(bn, e)  # boldface x, w in [Figure 14.15]
@@ -600,11 +1657,137 @@ def weighted_sample(bn, e):
 
 
 # _________________________________________________________________________
+# Vectorized forward sampling
+
+
+class ForwardSampler:
+    """Draws many samples of a BayesNet at once. The net is compiled
+    (BayesNet.compile) to integer parent indices and flat CPT arrays, and a
+    batch of samples is an array with a column per variable, filled in
+    topological order with one NumPy operation per node. Evidence variables are either clamped, each
+    sample being weighted by their likelihood (likelihood weighting), or
+    sampled, the samples inconsistent with them being rejected (rejection
+    sampling). Random numbers come from rng, by default a NumPy generator
+    seeded from the random module.
+    >>> random.seed(1017)
+    >>> ForwardSampler(burglary).ask('Burglary', dict(JohnCalls=T, MaryCalls=T), 10 ** 6).show_approx()
+    'False: 0.724, True: 0.276'
+    """
+
+    def __init__(self, bn, rng=None):
+        self.bn = bn
+        self.rng = rng
+        self.variables = list(bn.variables)
+        # For each node of the compiled net: its parents' columns, and either
+        # its flat table of P(X=true | parents), or, for a noisy-OR, the columns of
+        # the parents that make it true for sure (weight 1) and the weights
+        # of the others, or None when there are none (X is then their OR)
+        self.nodes = []
+        for node in bn.compile().nodes:
+            parents = list(node.parents)
+            if node.weights is not None:
+                certain = [j for j, w in zip(parents, node.weights) if w == 1]
+                uncertain = [(j, w) for j, w in zip(parents, node.weights) if w != 1]
+                noisy = (uncertain, node.leak) if uncertain or node.leak else None
+                self.nodes.append((certain, None, noisy))
+            else:
+                self.nodes.append((parents, node.cpt, None))
+
+    def sample(self, N, e=None, rejection=False, given=None):
+        """Return N samples as a boolean array (N, len(variables)) and their
+        weights. Evidence variables in e are clamped and weighted, unless
+        rejection is true: then they are sampled, and the weight of the
+        samples inconsistent with e is 0. given is a dict {X: array of N
+        values} of variables whose values are already known (e.g. those of
+        the previous time step), copied into the samples."""
+        e = e or {}
+        given = given or {}
+        rng = self.rng or np.random.default_rng(random.getrandbits(64))
+        samples = np.empty((N, len(self.variables)), dtype=bool, order='F')
+        weights = np.ones(N)
+        for i, (parents, table, noisy) in enumerate(self.nodes):
+            X = self.variables[i]
+            if X in given:
+                samples[:, i] = given[X]
+                continue
+            clamped = X in e and not rejection
+            if table is None:
+                # Noisy-OR: true if a certain parent is, or if the leak or one
+                # of the other true parents is not inhibited
+                value = np.zeros(N, dtype=bool)
+                for j in parents:
+                    value |= samples[:, j]
+                if noisy is not None and clamped:
+                    pfalse = np.full(N, 1 - noisy[1])
+                    for j, w in noisy[0]:
+                        pfalse *= 1 - w * samples[:, j]
+                    ptrue = np.where(value, 1.0, 1 - pfalse)
+                elif noisy is not None:
+                    uncertain, leak = noisy
+                    if leak:
+                        value |= rng.random(N, dtype=np.float32) < leak
+                    for j, w in uncertain:
+                        value |= samples[:, j] & (rng.random(N, dtype=np.float32) < w)
+                else:
+                    ptrue = value
+            else:
+                if not parents:
+                    ptrue = table[0]
+                elif len(parents) == 1:
+                    ptrue = np.where(samples[:, parents[0]], table[1], table[0])
+                else:
+                    index = np.zeros(N, dtype=np.intp)
+                    for j in parents:
+                        index <<= 1
+                        index |= samples[:, j]
+                    ptrue = table[index]
+                if not clamped:
+                    value = rng.random(N, dtype=np.float32) < ptrue
+
+            if clamped:
+                samples[:, i] = e[X]
+                weights *= ptrue if e[X] else 1 - ptrue
+            else:
+                samples[:, i] = value
+                if X in e:
+                    weights[samples[:, i] != e[X]] = 0
+        return samples, weights
+
+    def weighted_counts(self, e, N, variables=None, rejection=False, chunk=None):
+        """Return, for each of variables (default: all), the total weight of
+        the N samples where it is true, and the total weight of all of them.
+        The samples are drawn in chunks of about 2**26 values to bound
+        memory."""
+        columns = [self.bn.variable_index(X) for X in (self.variables if variables is None else variables)]
+        chunk = chunk or max(1, 2 ** 26 // max(1, len(self.variables)))
+        counts, total = np.zeros(len(columns)), 0.0
+        for start in range(0, N, chunk):
+            samples, weights = self.sample(min(chunk, N - start), e, rejection)
+            for k in range(0, len(columns), 256):
+                counts[k:k + 256] += weights @ samples[:, columns[k:k + 256]]
+            total += weights.sum()
+        return counts, total
+
+    def ask(self, X, e, N=10000, rejection=False):
+        """Estimate P(X | e) from N samples."""
+        return self.marginals([X], e, N, rejection)[X]
+
+    def marginals(self, variables, e, N=10000, rejection=False):
+        """Estimate P(X | e) for every X in variables from the same N samples.
+        Raises a ZeroDivisionError if all of them have weight 0."""
+        counts, total = self.weighted_counts(e, N, variables, rejection)
+        return {X: ProbDist(X, {True: float(count), False: float(total - count)}) for X, count in zip(variables, counts)}
 
 
-def gibbs_ask(X, e, bn, N=1000):
-    """[Figure 14.16]"""
+# _________________________________________________________________________
+
+
+def gibbs_ask(X, e, bn, N=1000, vectorized=False):
+    """[Figure 14.16]
+    With vectorized=True, N sweeps of a GibbsSampler are run instead."""
     assert X not in e, "Query variable must be distinct from evidence"
+    if vectorized:
+        return GibbsSampler(bn, e).run(N).marginal(X)
     counts = {x: 0 for x in bn.variable_values(X)}  # bold N in [Figure 14.16]
     Z = [var for var in bn.variables if var not in e]
     state = dict(e)  # boldface x in [Figure 14.16]
@@ -632,6 +1815,350 @@ def markov_blanket_sample(X, e, bn):
     return probability(Q.normalize()[True])
 
 
+class GibbsSampler:
+    """Gibbs sampling [Figure 14.16] with many independent chains, the
+    columns of one NumPy state array (a row per chain), updated together.
+    Variables are resampled in blocks: each block is drawn from its exact
+    conditional given the rest, by enumerating its joint values, which lets
+    strongly coupled variables (e.g. a room on fire over time) move
+    together. Each block's Markov blanket and CPT indices are compiled once.
+    Deterministic nodes (0/1 tables, and noisy-ORs with weights 1 and no
+    leak) are not sampled but computed from their parents, since sampling
+    them one at a time would never let their parents change; the noisy-ORs
+    are computed as the OR of their parents, without building their table.
+    Only the joint values of a block that its own CPTs and the evidence allow
+    are enumerated: a room's history, where fire persists, has one value per
+    instant fire starts (and one where it never does) instead of 2**n. Blocks
+    with more than max_assignments such values are split in two.
+    >>> random.seed(4)
+    >>> GibbsSampler(burglary, dict(JohnCalls=T, MaryCalls=T), chains=200).run(300, burn_in=50
+    ...  ).marginal('Burglary').show_approx()
+    'False: 0.715, True: 0.285'
+    >>> sampler = GibbsSampler(burglary, dict(JohnCalls=T, MaryCalls=T), [['Burglary', 'Earthquake', 'Alarm']])
+    >>> sampler.run(200, burn_in=0).marginal('Alarm').show_approx()
+    'False: 0.244, True: 0.756'
+
+    Fire persists, so the 15 instants of its history make one block of 16
+    valid values, which is not split:
+    >>> random.seed(1)
+    >>> dbn = DynamicBayesNet([('Fire', '', 0.1)], [('Fire', 'Fire', {T: 1.0, F: 0.05})],
+    ...                       [('Smoke', 'Fire', {T: 0.9, F: 0.1})])
+    >>> observations = [{'Smoke': t in (3, 9, 13, 14)} for t in range(15)]
+    >>> bn, e = dbn.unroll(observations), {'Smoke@%d' % t: o['Smoke'] for t, o in enumerate(observations)}
+    >>> sampler = GibbsSampler(bn, e, [['Fire@%d' % t for t in range(15)]], chains=200)
+    >>> len(sampler.blocks), len(sampler.plans[0][3])
+    (1, 16)
+    >>> sampler.run(200).marginal('Fire@14').show_approx(), elimination_ask('Fire@14', e, bn).show_approx()
+    ('False: 0.151, True: 0.849', 'False: 0.151, True: 0.849')
+    """
+
+    def __init__(self, bn, e, blocks=None, chains=100, rng=None, max_assignments=1024):
+        self.bn = bn
+        self.e = dict(e)
+        self.chains = chains
+        self.rng = rng or np.random.default_rng(random.getrandbits(64))
+        self.variables = list(bn.variables)
+        self.functional = {node.variable for node in bn.nodes
+                           if node.variable not in e and self.deterministic(node)}
+        stochastic = [X for X in self.variables if X not in e and X not in self.functional]
+
+        # Every stochastic variable is in exactly one block
+        blocks = [[X for X in block if X in stochastic] for block in (blocks or [])]
+        covered = {X for block in blocks for X in block}
+        blocks += [[X] for X in stochastic if X not in covered]
+        self.blocks, self.plans = [], []
+        pending = [block for block in reversed(blocks) if block]
+        while pending:
+            block = sorted(pending.pop(), key=bn.variable_index)
+            assignments = self.assignments(block, max_assignments)
+            if assignments is None:
+                pending += [block[len(block) // 2:], block[:len(block) // 2]]
+            else:
+                self.blocks.append(block)
+                self.plans.append(self.make_plan(block, assignments))
+
+        # Start the chains from samples consistent with the evidence, drawn
+        # in proportion to their likelihood weights, so that fewer of them
+        # start far from the posterior
+        samples, weights = ForwardSampler(bn, self.rng).sample(10 * chains, e)
+        if weights.sum() > 0:
+            samples = samples[self.rng.choice(len(samples), chains, p=weights / weights.sum())]
+        self.state = np.array(samples[:chains])
+        self.counts = np.zeros(len(self.variables))
+        self.kept = 0
+
+    @staticmethod
+    def deterministic(node):
+        """Is node's variable a function of its parents?"""
+        if isinstance(node, NoisyOrNode):
+            return all(w == 1 for w in node.weights) and node.leak == 0
+        return bool(np.all((node.table() == 0) | (node.table() == 1)))
+
+    def assignments(self, block, limit):
+        """Return the joint values of block (in topological order), a row each,
+        without those that a CPT of the block gives probability 0 whatever the
+        variables outside it (the evidence is fixed), or None if there are more
+        than limit. The values are extended one variable at a time, so a block
+        with few valid values is cheap however long it is."""
+        values = np.zeros((1, 0), dtype=bool)
+        for j, X in enumerate(block):
+            values = np.vstack([np.column_stack([values, np.full(len(values), x)]) for x in (False, True)])
+            node = self.bn.variable_node(X)
+            if 2 ** len(node.parents) <= limit:
+                # Which entries of the table, given X and its parents in the
+                # block, are positive for some value of the other parents
+                possible = node.table() > 0
+                for axis, Y in reversed(list(enumerate(node.parents, 1))):
+                    if Y in self.e:
+                        possible = np.take(possible, int(self.e[Y]), axis=axis)
+                    elif Y not in block[:j]:
+                        possible = possible.any(axis=axis)
+                columns = [j] + [block.index(Y) for Y in node.parents if Y in block[:j]]
+                values = values[possible[tuple(values[:, columns].T.astype(int))]]
+            if len(values) > limit:
+                return None
+        return values
+
+    def make_plan(self, block, assignments):
+        """Compile the update of block: the functional nodes it determines,
+        the factors (CPTs) that depend on it, and their indices into the
+        local columns of the state that they read."""
+        bn = self.bn
+        functional, stack = [], list(block)
+        while stack:
+            for child in bn.variable_node(stack.pop()).children:
+                if child.variable in self.functional and child.variable not in functional:
+                    functional.append(child.variable)
+                    stack.append(child.variable)
+        functional.sort(key=bn.variable_index)
+        changed = set(block) | set(functional)
+        factors = [bn.variable_node(X) for X in block]
+        for X in changed:
+            factors.extend(child for child in bn.variable_node(X).children
+                           if child.variable not in self.functional and child not in factors)
+
+        local = sorted({bn.variable_index(Y) for node in factors + [bn.variable_node(X) for X in functional]
+                        for Y in [node.variable] + node.parents})
+        position = {self.variables[j]: i for i, j in enumerate(local)}
+
+        # The flat index of a table entry (C order, [X] + parents) is the
+        # product of the local state and a column of strides. There is a
+        # column per factor, then one per functional node (without X itself).
+        nodes = factors + [bn.variable_node(X) for X in functional]
+        matrix = np.zeros((len(local), len(nodes)), dtype=np.intp)
+        for k, node in enumerate(nodes):
+            scope = [node.variable] + node.parents
+            for i, Y in enumerate(scope):
+                matrix[position[Y], k] = 2 ** (len(scope) - 1 - i)
+        # A functional noisy-OR is the OR of its parents, so it needs no table:
+        # without its own stride, its index is positive when any parent is true
+        computed = []
+        for k, X in enumerate(functional, len(factors)):
+            offset = matrix[position[X], k]
+            matrix[position[X], k] = 0
+            columns = np.flatnonzero(matrix[position[X]])
+            node = bn.variable_node(X)
+            table = None if isinstance(node, NoisyOrNode) else node.table().ravel()
+            computed.append((k, position[X], table, offset, columns, matrix[position[X], columns]))
+
+        # The index is the sum of a part given by the other variables of the
+        # chain, one given by the values of the block, and one given by the
+        # functional nodes, added as they are computed
+        rows = [position[X] for X in block]
+        fixed = [i for i in range(len(local)) if i not in rows and all(i != c[1] for c in computed)]
+        tables = [node.table().ravel() for node in factors]
+        offsets = np.cumsum([0] + [len(table) for table in tables[:-1]])
+        return (local, rows, fixed, assignments, assignments @ matrix[rows], matrix, computed,
+                offsets, np.concatenate(tables))
+
+    def update(self, plan):
+        """Resample the block of plan in every chain from its conditional."""
+        local, rows, fixed, assignments, assigned, matrix, computed, offsets, tables = plan
+        state = self.state[:, local]
+        # index[chain, assignment, column]
+        index = (state[:, fixed] @ matrix[fixed])[:, None, :] + assigned[None, :, :]
+        values = []
+        for k, X, table, offset, columns, strides in computed:
+            value = index[:, :, k] > 0 if table is None else table[index[:, :, k] + offset] > 0.5
+            index[:, :, columns] += value[:, :, None] * strides
+            values.append(value)
+        weights = tables[index[:, :, :len(offsets)] + offsets].prod(axis=2)
+
+        # Draw an assignment per chain by inverting the cumulative weights
+        cumulative = np.cumsum(weights, axis=1)
+        u = self.rng.random(len(state)) * cumulative[:, -1]
+        choice = np.minimum((cumulative < u[:, None]).sum(axis=1), len(assignments) - 1)
+        state[:, rows] = assignments[choice]
+        chains = np.arange(len(state))
+        for (_, X, _, _, _, _), value in zip(computed, values):
+            state[:, X] = value[chains, choice]
+        self.state[:, local] = state
+
+    def run(self, sweeps, burn_in=None, thin=1):
+        """Run sweeps sweeps over all the blocks, after burn_in more (default
+        sweeps // 5) whose states are discarded, and count every thin-th
+        state of every chain. Returns self."""
+        if burn_in is None:
+            burn_in = sweeps // 5
+        for sweep in range(burn_in + sweeps):
+            for plan in self.plans:
+                self.update(plan)
+            if sweep >= burn_in and (sweep - burn_in) % thin == 0:
+                self.counts += self.state.sum(axis=0)
+                self.kept += len(self.state)
+        return self
+
+    def marginal(self, X):
+        """Return the estimate of P(X | e) from the states counted so far."""
+        true = float(self.counts[self.bn.variable_index(X)])
+        return ProbDist(X, {True: true, False: self.kept - true})
+
+    def marginals(self, variables=None):
+        """Return a dict {X: P(X | e)} for variables (default: all)."""
+        if variables is None:
+            variables = self.variables
+        return {X: self.marginal(X) for X in variables}
+
+
+# _________________________________________________________________________
+# Loopy belief propagation
+
+
+class LoopyBeliefPropagation:
+    """Sum-product belief propagation [Pearl, 1988] on the factor graph of a
+    BayesNet, run even though the graph has loops: the beliefs are then only
+    approximations of the marginals, but each iteration is linear in the size
+    of the network. The factors (one per CPT) are grouped by arity, and the
+    messages of a group are computed together by one einsum per argument
+    position. Each message is damped, new = (1 - damping) * new + damping * old,
+    and with the 'residual' schedule an iteration only commits the fraction
+    of the messages that changed the most [Elidan et al., 2006], instead of
+    all of them ('synchronous'). Iterations stop when no message changes by
+    more than tol, or after max_iter; iterations, residual and converged
+    report how it went.
+    >>> bp = LoopyBeliefPropagation(burglary).run(dict(JohnCalls=T, MaryCalls=T))
+    >>> bp.marginal('Burglary').show_approx()
+    'False: 0.716, True: 0.284'
+    >>> bp.converged
+    True
+
+    The sprinkler network has a loop, so there the beliefs are off (the exact
+    answer is 'False: 0.424, True: 0.576'):
+    >>> LoopyBeliefPropagation(sprinkler).run(dict(WetGrass=T)).marginal('Cloudy').show_approx()
+    'False: 0.396, True: 0.604'
+    """
+
+    def __init__(self, bn, damping=0.5, schedule='residual', fraction=0.5, max_iter=100, tol=1e-6):
+        assert 0 <= damping < 1 and 0 < fraction <= 1
+        assert schedule in ('residual', 'synchronous')
+        self.bn = bn
+        self.damping = damping
+        self.schedule = schedule
+        self.fraction = fraction
+        self.max_iter = max_iter
+        self.tol = tol
+        self.variables = list(bn.variables)
+
+        # groups[k] = (tables (F, 2, ..., 2), first edge, einsum subscripts of
+        # the message to each argument); edge first + k * f + j joins the
+        # factor f of the group and its j-th variable
+        arities = defaultdict(list)
+        for node in bn.compile().nodes:
+            arities[len(node.parents) + 1].append(node)
+        self.groups = []
+        targets = []
+        for k, nodes in sorted(arities.items()):
+            tables = np.stack([node.table() for node in nodes])
+            letters = [chr(ord('b') + j) for j in range(k)]
+            subscripts = [','.join(['a' + ''.join(letters)] + ['a' + letters[i] for i in range(k) if i != j])
+                          + '->a' + letters[j] for j in range(k)]
+            self.groups.append((tables, len(targets), subscripts))
+            targets.extend(j for node in nodes for j in (node.index,) + node.parents)
+        self.targets = np.array(targets, dtype=np.intp)
+        self.beliefs = None
+        self.iterations = 0
+        self.residual = np.inf
+        self.converged = False
+
+    def incoming(self, unary, messages):
+        """Return the beliefs, and the message from every variable to each of
+        its factors: the product of its evidence and of the messages from its
+        other factors. Zeros are counted apart from the sum of the logarithms
+        of the others, so that a message can be left out without dividing."""
+        n = len(self.variables)
+        zero = messages == 0
+        with np.errstate(divide='ignore'):
+            logs = np.where(zero, 0, np.log(np.where(zero, 1, messages)))
+        total = np.stack([np.bincount(self.targets, logs[:, x], n) for x in (0, 1)], axis=1)
+        zeros = np.stack([np.bincount(self.targets, zero[:, x], n) for x in (0, 1)], axis=1)
+        beliefs = unary * np.where(zeros > 0, 0, np.exp(total - total.max(axis=1, keepdims=True)))
+        others = total[self.targets] - logs
+        outgoing = np.where(zeros[self.targets] - zero > 0, 0, np.exp(others - others.max(axis=1, keepdims=True)))
+        return beliefs, normalized(outgoing * unary[self.targets])
+
+    def outgoing(self, incoming):
+        """Return the message from every factor to each of its variables."""
+        messages = np.empty_like(incoming)
+        for tables, first, subscripts in self.groups:
+            k = len(subscripts)
+            inputs = incoming[first:first + k * len(tables)].reshape(len(tables), k, 2)
+            for j, subscript in enumerate(subscripts):
+                messages[first + j:first + k * len(tables):k] = np.einsum(
+                    subscript, tables, *(inputs[:, i] for i in range(k) if i != j))
+        return normalized(messages)
+
+    def run(self, e):
+        """Propagate the evidence e until convergence. Returns self."""
+        unary = np.ones((len(self.variables), 2))
+        for X, x in e.items():
+            unary[self.bn.variable_index(X), int(not x)] = 0
+        messages = np.full((len(self.targets), 2), 0.5)
+        self.converged = False
+        for self.iterations in range(1, self.max_iter + 1):
+            new = self.outgoing(self.incoming(unary, messages)[1])
+            new = normalized((1 - self.damping) * new + self.damping * messages)
+            residuals = np.abs(new - messages).max(axis=1)
+            self.residual = float(residuals.max(initial=0))
+            if self.residual <= self.tol:
+                self.converged = True
+                break
+            if self.schedule == 'residual':
+                # Messages tied with the last one selected are committed too
+                m = max(1, int(self.fraction * len(residuals)))
+                threshold = np.partition(residuals, len(residuals) - m)[len(residuals) - m]
+                update = residuals >= max(threshold, self.tol)
+                messages[update] = new[update]
+            else:
+                messages = new
+        self.beliefs = normalized(self.incoming(unary, messages)[0])
+        return self
+
+    def marginal(self, X):
+        """Return the belief of X, the approximation of P(X | e)."""
+        return Factor([X], self.beliefs[self.bn.variable_index(X)]).normalize()
+
+    def marginals(self, variables=None):
+        """Return a dict {X: P(X | e)} for variables (default: all)."""
+        if variables is None:
+            variables = self.variables
+        return {X: self.marginal(X) for X in variables}
+
+
+def normalized(messages):
+    """Return the rows of messages scaled to sum to 1 (all-zero rows are kept:
+    they stand for contradictory evidence)."""
+    total = messages.sum(axis=1, keepdims=True)
+    return messages / np.where(total > 0, total, 1)
+
+
+def loopy_bp_ask(X, e, bn, damping=0.5, max_iter=100):
+    """Approximate bn's P(X|e) by loopy belief propagation.
+    >>> loopy_bp_ask('Rain', dict(Sprinkler=T), sprinkler).show_approx()
+    'False: 0.7, True: 0.3'
+    """
+    return LoopyBeliefPropagation(bn, damping, max_iter=max_iter).run(e).marginal(X)
+
+
 # _________________________________________________________________________
 
 
@@ -808,6 +2335,384 @@ def particle_filtering(e, N, HMM):
     return s
 
 
+# _________________________________________________________________________
+# Dynamic Bayesian networks [Section 15.5]
+
+
+class DynamicBayesNet:
+    """A dynamic Bayesian network of boolean variables: a prior slice and a
+    transition slice repeated at every later time step.
+
+    * prior: node specs (X, parents, cpt) for slice 0. Its variables are
+      the state variables.
+
+    * transition: node specs (or nodes) for a later slice, parents before children,
+      defining every state variable once. A parent that is a state variable
+      is its value in the previous slice; any other parent is an
+      intermediate variable of the same slice, declared earlier.
+
+    * sensors: node specs (E, X, cpt) for the evidence variables, each with
+      a single state variable X of its own slice as parent.
+
+    Inside self.transition, the previous slice's copy of a state variable X
+    is a root named X@-1 (its cpt is unused).
+    >>> dbn = DynamicBayesNet([('Rain', '', 0.5)], [('Rain', 'Rain', {T: 0.7, F: 0.3})],
+    ...                       [('Umbrella', 'Rain', {T: 0.9, F: 0.2})])
+    >>> dbn.unroll([{'Umbrella': T}, {}])
+    BayesNet([('Rain@0', '', {(): 0.5}), ('Umbrella@0', 'Rain@0', {(True,): 0.9, (False,): 0.2}), \
+('Rain@1', 'Rain@0', {(True,): 0.7, (False,): 0.3})])
+    """
+
+    def __init__(self, prior, transition, sensors):
+        self.prior = BayesNet(prior)
+        self.state = list(self.prior.variables)
+        self.previous = {X: X + '@-1' for X in self.state}
+        self.transition = BayesNet([(self.previous[X], '', 0.5) for X in self.state])
+        for spec in transition:
+            node = spec if isinstance(spec, BayesNode) else BayesNode(*spec)
+            self.transition.add(node.relabel(node.variable, [self.previous.get(Y, Y) for Y in node.parents]))
+        assert all(X in self.transition.variable_nodes for X in self.state)
+        self.sensors = {}
+        for E, X, cpt in sensors:
+            node = BayesNode(E, X, cpt)
+            assert node.parents[0] in self.state
+            self.sensors[E] = node
+
+    def slice_nodes(self):
+        """The nodes of the transition slice itself (not the previous state)."""
+        return self.transition.nodes[len(self.state):]
+
+    def unroll(self, observations):
+        """Return the BayesNet for len(observations) slices, where
+        observations[t] holds the evidence variables observed at time t. Every
+        variable X of slice t is named X@t."""
+        previous = {Y: X for X, Y in self.previous.items()}
+        bn = BayesNet()
+        for t, observed in enumerate(observations):
+            if t == 0:
+                for node in self.prior.nodes:
+                    bn.add(node.relabel(node.variable + '@0', [Y + '@0' for Y in node.parents]))
+            else:
+                for node in self.slice_nodes():
+                    parents = [previous[Y] + '@{}'.format(t - 1) if Y in previous else Y + '@{}'.format(t)
+                               for Y in node.parents]
+                    bn.add(node.relabel(node.variable + '@{}'.format(t), parents))
+            for E in observed:
+                node = self.sensors[E]
+                bn.add(node.relabel(E + '@{}'.format(t), [node.parents[0] + '@{}'.format(t)]))
+        return bn
+
+
+class FrontierFilter:
+    """Exact filtering in a DynamicBayesNet. The belief state is a single
+    Factor over the state variables of the current slice (the interface
+    between past and future), so each step costs the same however many came
+    before. advance() multiplies in the transition nodes one at a time,
+    summing out each previous-slice or intermediate variable as soon as no
+    node left needs it (the frontier algorithm).
+    >>> dbn = DynamicBayesNet([('Rain', '', 0.5)], [('Rain', 'Rain', {T: 0.7, F: 0.3})],
+    ...                       [('Umbrella', 'Rain', {T: 0.9, F: 0.2})])
+    >>> f = FrontierFilter(dbn)
+    >>> f.observe({'Umbrella': T})
+    >>> f.advance()
+    >>> f.observe({'Umbrella': T})
+    >>> f.marginal('Rain').show_approx()
+    'False: 0.117, True: 0.883'
+    """
+
+    def __init__(self, dbn):
+        self.dbn = dbn
+        self.belief = pointwise_product([make_factor(X, {}, dbn.prior) for X in dbn.prior.variables], dbn.prior)
+        self.t = 0
+        self.schedule = self.make_schedule()
+
+    def make_schedule(self):
+        """Return the transition steps as a list of (factor, variables kept
+        after multiplying it into the belief). Nodes are taken greedily, the
+        one leaving the smallest frontier first, ties in network order."""
+        dbn = self.dbn
+        pending = list(dbn.slice_nodes())
+        frontier = [dbn.previous[X] for X in dbn.state]
+        schedule = []
+        while pending:
+            def frontier_after(node):
+                added = frontier + [X for X in [node.variable] + node.parents if X not in frontier]
+                return [X for X in added if X in dbn.state or any(X in n.parents for n in pending if n is not node)]
+
+            ready = [node for node in pending if all(X in frontier or X in dbn.previous.values() for X in node.parents)]
+            node = min(ready, key=lambda n: len(frontier_after(n)))
+            frontier = frontier_after(node)
+            pending.remove(node)
+            schedule.append((make_factor(node.variable, {}, dbn.transition), frontier))
+        return schedule
+
+    def observe(self, readings):
+        """Condition the belief on readings, a dict {evidence variable: value}
+        for the current slice."""
+        factors = [self.belief]
+        for E, value in readings.items():
+            node = self.dbn.sensors[E]
+            factors.append(Factor(node.parents, node.table()[int(value)]))
+        self.belief = sum_product(factors, self.belief.variables)
+        self.belief.cpt /= self.belief.cpt.sum()
+
+    def advance(self):
+        """Move the belief state one time step forward."""
+        belief = Factor([self.dbn.previous[X] for X in self.belief.variables], self.belief.cpt)
+        for factor, variables in self.schedule:
+            belief = sum_product([belief, factor], variables)
+        self.belief = belief
+        self.t += 1
+
+    def marginal(self, X):
+        """Return P(X | observations so far) for a state variable X."""
+        return sum_product([self.belief], [X]).normalize()
+
+    def marginals(self):
+        """Return a dict {X: P(X | observations so far)} for every state variable."""
+        return {X: self.marginal(X) for X in self.dbn.state}
+
+
+class BoyenKollerFilter:
+    """Approximate filtering in a DynamicBayesNet [Boyen and Koller, 1998].
+    The belief is kept as a product of independent distributions over clusters
+    of state variables, and projected back onto that form after every step,
+    so the cost grows with the cluster sizes instead of the whole slice.
+    With clusters=None every state variable is its own cluster (the factored
+    frontier algorithm): the belief is then a vector of P(X=true), and each
+    step is vectorized over the variables with NumPy.
+    >>> dbn = DynamicBayesNet([('Rain', '', 0.5)], [('Rain', 'Rain', {T: 0.7, F: 0.3})],
+    ...                       [('Umbrella', 'Rain', {T: 0.9, F: 0.2})])
+    >>> f = BoyenKollerFilter(dbn)
+    >>> f.observe({'Umbrella': T})
+    >>> f.advance()
+    >>> f.observe({'Umbrella': T})
+    >>> f.marginal('Rain').show_approx()
+    'False: 0.117, True: 0.883'
+    """
+
+    def __init__(self, dbn, clusters=None):
+        self.dbn = dbn
+        self.t = 0
+        prior = JunctionTree(dbn.prior, ()).calibrate({})
+        if clusters is None:
+            self.clusters = None
+            self.index = {X: i for i, X in enumerate(dbn.state)}
+            self.belief = np.array([prior.marginal(X)[True] for X in dbn.state])
+            self.levels = self.make_levels()
+        else:
+            self.clusters = [list(cluster) for cluster in clusters]
+            assert sorted(X for cluster in self.clusters for X in cluster) == sorted(dbn.state)
+            self.cluster_of = {X: i for i, cluster in enumerate(self.clusters) for X in cluster}
+            prior_factors = [make_factor(X, {}, dbn.prior) for X in dbn.prior.variables]
+            self.belief = [sum_product(prior_factors, cluster) for cluster in self.clusters]
+            self.schedule = [self.make_cluster_step(cluster) for cluster in self.clusters]
+
+    def make_levels(self):
+        """Compile the transition slice for the per-variable filter. Values are
+        kept in one vector of slots: the previous state variables, the slice
+        nodes, and a last slot that is always 0. Nodes are grouped by level
+        (nodes of a level only depend on earlier levels), then noisy-OR nodes
+        form one group ('noisy_or', slots, parent slots padded with the zero
+        slot, weights, leaks) and the others are grouped by number of parents
+        ('table', slots, parent slots, stacked P(X=true | parents) tables)."""
+        dbn = self.dbn
+        nodes = dbn.slice_nodes()
+        n = len(dbn.state)
+        slot = {dbn.previous[X]: i for i, X in enumerate(dbn.state)}
+        slot.update((node.variable, n + i) for i, node in enumerate(nodes))
+        level = {}
+        for node in nodes:
+            level[node.variable] = 1 + max([level.get(Y, -1) for Y in node.parents], default=-1)
+        self.slots = n + len(nodes) + 1
+        self.state_slots = np.array([slot[X] for X in dbn.state])
+
+        levels = []
+        for l in range(1 + max(level.values(), default=-1)):
+            groups = []
+            noisy_or = [node for node in nodes if level[node.variable] == l and isinstance(node, NoisyOrNode)]
+            if noisy_or:
+                k = max(len(node.parents) for node in noisy_or)
+                pad = [[self.slots - 1] * (k - len(node.parents)) for node in noisy_or]
+                groups.append(('noisy_or', np.array([slot[node.variable] for node in noisy_or]),
+                               np.array([[slot[Y] for Y in node.parents] + p for node, p in zip(noisy_or, pad)],
+                                        dtype=int).reshape(len(noisy_or), k),
+                               np.array([list(node.weights) + [0] * len(p) for node, p in zip(noisy_or, pad)]
+                                        ).reshape(len(noisy_or), k),
+                               np.array([node.leak for node in noisy_or])))
+            tables = defaultdict(list)
+            for node in nodes:
+                if level[node.variable] == l and not isinstance(node, NoisyOrNode):
+                    tables[len(node.parents)].append(node)
+            for k, group in sorted(tables.items()):
+                groups.append(('table', np.array([slot[node.variable] for node in group]),
+                               np.array([[slot[Y] for Y in node.parents] for node in group], dtype=int).reshape(len(group), k),
+                               np.stack([node.table()[1] for node in group])))
+            levels.append(groups)
+        return levels
+
+    def make_cluster_step(self, cluster):
+        """Return (clusters of the previous belief, transition factors) whose
+        product, summed down to cluster, is the cluster's next belief."""
+        dbn = self.dbn
+        nodes, needed = [], set(cluster)
+        for node in reversed(dbn.slice_nodes()):
+            if node.variable in needed:
+                nodes.append(node)
+                needed.update(node.parents)
+        previous = {X: Y for Y, X in dbn.previous.items()}
+        old = sorted({self.cluster_of[previous[X]] for X in needed if X in previous})
+        return old, [make_factor(node.variable, {}, dbn.transition) for node in nodes]
+
+    def observe(self, readings):
+        """Condition the belief on readings, a dict {evidence variable: value}
+        for the current slice."""
+        if self.clusters is None:
+            likelihood = np.ones((2, len(self.dbn.state)))
+            for E, value in readings.items():
+                node = self.dbn.sensors[E]
+                likelihood[:, self.index[node.parents[0]]] *= node.table()[int(value)]
+            ptrue = self.belief * likelihood[1]
+            self.belief = ptrue / (ptrue + (1 - self.belief) * likelihood[0])
+        else:
+            for E, value in readings.items():
+                node = self.dbn.sensors[E]
+                i = self.cluster_of[node.parents[0]]
+                belief = sum_product([self.belief[i], Factor(node.parents, node.table()[int(value)])],
+                                     self.belief[i].variables)
+                self.belief[i] = Factor(belief.variables, belief.cpt / belief.cpt.sum())
+
+    def advance(self):
+        """Move the belief one time step forward and project it back onto
+        independent clusters."""
+        if self.clusters is None:
+            values = np.zeros(self.slots)
+            values[:len(self.belief)] = self.belief
+            for groups in self.levels:
+                for kind, slots, parent_slots, *parameters in groups:
+                    m = values[parent_slots]
+                    if kind == 'noisy_or':
+                        # Each independent parent is an active cause with probability weight * P(parent)
+                        weights, leaks = parameters
+                        values[slots] = 1 - (1 - leaks) * np.prod(1 - weights * m, axis=1)
+                    else:
+                        # Average P(X=true | parents) over independent parents, one parent axis at a time
+                        ptrue, = parameters
+                        for j in reversed(range(parent_slots.shape[1])):
+                            mj = m[:, j].reshape((-1,) + (1,) * (ptrue.ndim - 2))
+                            ptrue = ptrue[..., 0] * (1 - mj) + ptrue[..., 1] * mj
+                        values[slots] = ptrue
+            self.belief = values[self.state_slots]
+        else:
+            old = [Factor([self.dbn.previous[X] for X in f.variables], f.cpt) for f in self.belief]
+            self.belief = [sum_product([old[i] for i in clusters] + factors, cluster)
+                           for cluster, (clusters, factors) in zip(self.clusters, self.schedule)]
+        self.t += 1
+
+    def marginal(self, X):
+        """Return the approximate P(X | observations so far) for a state variable X."""
+        if self.clusters is None:
+            p = float(self.belief[self.index[X]])
+            return ProbDist(X, {True: p, False: 1 - p})
+        return sum_product([self.belief[self.cluster_of[X]]], [X]).normalize()
+
+    def marginals(self):
+        """Return a dict {X: approximate P(X | observations so far)} for every state variable."""
+        return {X: self.marginal(X) for X in self.dbn.state}
+
+
+class ParticleFilter:
+    """Particle filtering [Figure 15.17] in a DynamicBayesNet. Each particle
+    is a boolean vector over the state variables, a row of an (N, state)
+    array. advance() samples every particle's next state from the transition
+    slice at once (ForwardSampler), and observe() weights the particles by
+    the likelihood of the readings. The particles are resampled only when
+    the effective sample size 1 / sum(w^2) falls below threshold * N, by
+    systematic or residual resampling (both draw a single uniform for the
+    whole population, unlike N independent draws).
+    Raises a ZeroDivisionError when no particle is consistent with the
+    readings.
+    >>> dbn = DynamicBayesNet([('Rain', '', 0.5)], [('Rain', 'Rain', {T: 0.7, F: 0.3})],
+    ...                       [('Umbrella', 'Rain', {T: 0.9, F: 0.2})])
+    >>> random.seed(2)
+    >>> f = ParticleFilter(dbn, 100000)
+    >>> f.observe({'Umbrella': T})
+    >>> f.advance()
+    >>> f.observe({'Umbrella': T})
+    >>> f.marginal('Rain').show_approx()
+    'False: 0.116, True: 0.884'
+    """
+
+    def __init__(self, dbn, N=1000, resampling='systematic', threshold=0.5, rng=None):
+        assert resampling in ('systematic', 'residual')
+        self.dbn = dbn
+        self.N = N
+        self.resampling = resampling
+        self.threshold = threshold
+        self.rng = rng or np.random.default_rng(random.getrandbits(64))
+        self.transition = ForwardSampler(dbn.transition, self.rng)
+        self.columns = [dbn.transition.variable_index(X) for X in dbn.state]
+        self.position = {X: i for i, X in enumerate(dbn.state)}
+        self.particles = ForwardSampler(dbn.prior, self.rng).sample(N)[0]
+        self.weights = np.full(N, 1 / N)
+        self.t = 0
+        self.resamplings = 0
+
+    def observe(self, readings):
+        """Weight the particles by the likelihood of readings, a dict
+        {evidence variable: value} for the current slice, and resample them
+        if their effective number has become too small."""
+        for E, value in readings.items():
+            node = self.dbn.sensors[E]
+            ptrue = node.table()[1][self.particles[:, self.position[node.parents[0]]].astype(int)]
+            self.weights *= ptrue if value else 1 - ptrue
+        total = self.weights.sum()
+        if total == 0:
+            raise ZeroDivisionError("No particle is consistent with the readings")
+        self.weights /= total
+        if 1 / np.sum(self.weights ** 2) < self.threshold * self.N:
+            self.resample()
+
+    def resample(self):
+        """Draw N particles in proportion to their weights, which become equal."""
+        N = self.N
+        if self.resampling == 'residual':
+            # Each particle is kept floor(N w) times, and the rest are drawn
+            # systematically from the remainders
+            copies = np.floor(N * self.weights).astype(int)
+            remainder = N * self.weights - copies
+            indices = np.repeat(np.arange(N), copies)
+            if len(indices) < N:
+                indices = np.concatenate([indices, self.systematic(remainder / remainder.sum(), N - len(indices))])
+        else:
+            indices = self.systematic(self.weights, N)
+        self.particles = self.particles[indices]
+        self.weights = np.full(N, 1 / N)
+        self.resamplings += 1
+
+    def systematic(self, weights, n):
+        """Return n indices drawn by systematic resampling: the points
+        (u + i) / n for a single uniform u, located in the cumulative weights."""
+        positions = (self.rng.random() + np.arange(n)) / n
+        return np.minimum(np.searchsorted(np.cumsum(weights), positions), len(weights) - 1)
+
+    def advance(self):
+        """Move every particle one time step forward."""
+        given = {self.dbn.previous[X]: self.particles[:, i] for i, X in enumerate(self.dbn.state)}
+        self.particles = self.transition.sample(self.N, given=given)[0][:, self.columns]
+        self.t += 1
+
+    def marginal(self, X):
+        """Return P(X | observations so far) for a state variable X."""
+        true = float(self.weights @ self.particles[:, self.position[X]])
+        return ProbDist(X, {True: true, False: 1 - true})
+
+    def marginals(self):
+        """Return a dict {X: P(X | observations so far)} for every state variable."""
+        true = self.weights @ self.particles
+        return {X: ProbDist(X, {True: float(p), False: 1 - float(p)}) for X, p in zip(self.dbn.state, true)}
+
+
 # _________________________________________________________________________
 # TODO: Implement continuous map for MonteCarlo similar to Fig25.10 from the book
 